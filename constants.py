@@ -1,4 +1,5 @@
 from collections import Counter
+import os
 
 CALLS_TO_INGORE = {
     'set', 'list','round', 'range', 'print', 'sorted', 'max', 'len',
@@ -13,6 +14,30 @@ TEMPERATURE = 0.8
 STOP_TOKENS=['<|EOT|>', '<STOP>']
 OPENAI = 'openai'
 LOCAL = 'local'
+OPENAI_URL = 'https://api.openai.com'
+
+CONNECT_TIMEOUT = 10
+READ_TIMEOUT = 600
+API_RETRIES = 5
+BACKOFF_BASE = 1
+BACKOFF_MAX = 60
+ENDPOINT_RECHECK_INTERVAL = 30
+
+CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'lmdocs')
+CACHE_SIZE_MB = 512
+PARSE_CACHE_VERSION = 3  # Bump when the data extracted from each file changes, to invalidate the parse cache
+
+SUMMARIZE_BATCH_TOKENS = 2000
+CONTEXT_SIZE = 16384
+
+# Pipeline stages recorded in the metrics
+SCAN = 'scan'
+REFERENCE_LOOKUP = 'reference_lookup'
+SUMMARIZATION = 'summarization'
+GENERATION = 'generation'
+VERIFICATION = 'verification'
+WRITE_BACK = 'write_back'
+STAGES = [SCAN, REFERENCE_LOOKUP, SUMMARIZATION, GENERATION, VERIFICATION, WRITE_BACK]
 
 TOK_COUNT = Counter({
         "prompt_tokens": 0,
@@ -1,6 +1,154 @@
 import logging
-from prompts import SYSTEM_PROMPT, DOC_SUMMARIZATION_PROMPT
+import heapq
+import ast
+import sys
+from array import array
+import json
+import mmap
+import re
+from concurrent.futures import ThreadPoolExecutor
+from prompts import SYSTEM_PROMPT, DOC_SUMMARIZATION_PROMPT, DOC_BATCH_SUMMARIZATION_PROMPT, format_docs, estimate_tokens
 from llm_inference import get_llm_output
+from metrics import get_metrics
+from constants import SUMMARIZATION
+
+class CodeBlob:
+    # One slot per CodeData key, the slot names are the key values (dependencies are stored in the CodeData graph)
+    __slots__ = (
+        'documentation', 'documentation_short', 'code', 'code_new', 'code_indent',
+        'node', 'span', 'fingerprint', 'custom', 'path', 'code_type',
+    )
+
+    def __init__(self):
+        """
+        Initializes the record of a function/class/method or of a called function, with the defaults of an unknown call.
+
+        Fields are read and written like the keys of a dict, e.g. `blob[CodeData.DOC]`, without a dict per record.
+
+        Input:
+            None
+
+        Returns:
+            None
+
+        Raises:
+            None
+        """
+        self.documentation = '-'
+        self.documentation_short = '-'
+        self.code = '-'
+        self.code_new = '-'
+        self.code_indent = ''
+        self.node = None
+        self.span = None
+        self.fingerprint = None
+        self.custom = False
+        self.path = '-'
+        self.code_type = '??'
+
+    def __getitem__(self, key):
+        """
+        Get a field of the record.
+
+        Input:
+            key (str): One of the CodeData keys.
+
+        Returns:
+            The value of the field.
+
+        Raises:
+            KeyError: If the key is not a CodeData key.
+        """
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key) from None
+
+    def __setitem__(self, key, value):
+        """
+        Set a field of the record.
+
+        Input:
+            key (str): One of the CodeData keys.
+            value: The new value of the field.
+
+        Returns:
+            None
+
+        Raises:
+            KeyError: If the key is not a CodeData key.
+        """
+        try:
+            setattr(self, key, value)
+        except AttributeError:
+            raise KeyError(key) from None
+
+    def get(self, key, default=None):
+        """
+        Get a field of the record, like `dict.get`.
+
+        Input:
+            key (str): One of the CodeData keys.
+            default: Returned if the key is not a CodeData key.
+
+        Returns:
+            The value of the field, or the default.
+
+        Raises:
+            None
+        """
+        return getattr(self, key, default)
+
+
+class MissingCodeBlob(CodeBlob):
+    __slots__ = ()
+
+    def __init__(self):
+        """
+        Initializes the shared, read-only record returned for names that are not in the code data.
+
+        Input:
+            None
+
+        Returns:
+            None
+
+        Raises:
+            None
+        """
+        for key in CodeBlob.__slots__:
+            object.__setattr__(self, key, getattr(CodeBlob(), key))
+
+    def __setattr__(self, key, value):
+        """
+        Refuse to modify the shared record.
+
+        Raises:
+            TypeError: Always, add the name to the code data instead.
+        """
+        raise TypeError('The record of a missing code blob is read-only, use CodeData.add')
+
+
+MISSING_BLOB = MissingCodeBlob()
+
+
+def read_segment(buf, start, end):
+    """
+    Decode a segment of a Python file, with `\n` line endings like a file read in text mode.
+
+    Input:
+        buf (bytes or mmap.mmap): The content of the file, or part of it.
+        start (int): Byte offset of the start of the segment in `buf`.
+        end (int): Byte offset of the end of the segment in `buf`.
+
+    Returns:
+        str: The decoded segment.
+
+    Raises:
+        UnicodeDecodeError: If the segment is not valid UTF-8.
+    """
+    return buf[start:end].decode('utf-8').replace('\r\n', '\n').replace('\r', '\n')
+
 
 class CodeData:
     
@@ -11,24 +159,25 @@ class CodeData:
     CODE_NEW = 'code_new'
     CODE_INDENT = 'code_indent'
     NODE = 'node'
+    SPAN = 'span'
+    FINGERPRINT = 'fingerprint'
     CUSTOM = 'custom'
     PATH = 'path'
     TYPE = 'code_type'
     
     def __init__(self):
         self.code_blobs = {}
-        self.DEFAULT_OUTPUT = {
-            CodeData.DEP: [], 
-            CodeData.DOC: '-',
-            CodeData.DOC_SHORT: '-',
-            CodeData.NODE: None, 
-            CodeData.CODE: '-',
-            CodeData.CODE_NEW: '-',
-            CodeData.CUSTOM: False,
-            CodeData.PATH: '-',
-            CodeData.CODE_INDENT: '',
-            CodeData.TYPE: '??',
-        }
+        # Dependency graph between integer ids of the names, only for names with dependencies/dependents
+        self.ids = {}  # Name -> id
+        self.names = []  # Id -> name
+        self.forward = {}  # Id -> array of the ids of its dependencies, in order of first occurence
+        self.reverse = {}  # Id -> array of the ids of its dependents
+        self.edges = set()  # (dependent id << 32) | dependency id of every edge, to add each edge once
+        self.order = {}  # Custom code blob -> position, used to pick ready code blobs deterministically
+        self.pending = {}  # Custom code blob -> number of unprocessed custom dependencies
+        self.ready = []  # Heap of (position, name) of custom code blobs whose dependencies are processed
+        self.queued = set()  # Custom code blobs that were pushed to the ready heap
+        self.processed = set()  # Custom code blobs whose documentation is recorded (or given up on)
         
     def __getitem__(self, name):
         """
@@ -38,12 +187,12 @@ class CodeData:
         - name (str): The name of the code blob to retrieve.
     
         Returns:
-        - dict: The code blob associated with the specified name, or a copy of the default output if the name is not found.
+        - CodeBlob: The code blob associated with the specified name, or the shared read-only default if the name is not found.
     
         Raises:
-        - KeyError: If the name is not found in the code blobs and the default output is not available for copying.
+        - None
         """
-        return self.code_blobs.get(name, self.DEFAULT_OUTPUT.copy())
+        return self.code_blobs.get(name, MISSING_BLOB)
     
     def add(self, name, data):
         """
@@ -60,20 +209,261 @@ class CodeData:
             KeyError: If a required key is missing from the data dictionary.
         """
         
-        if name not in self.code_blobs:
+        blob = self.code_blobs.get(name)
+        if blob is None:
             # Initialize a new code blob if the name is not already present
-            self.code_blobs[name] = self.DEFAULT_OUTPUT.copy()
+            name = sys.intern(name)
+            blob = self.code_blobs[name] = CodeBlob()
             
         for k, v in data.items():
             if k == CodeData.DEP:
-                # Update dependencies by appending new dependencies to the existing list
-                self.code_blobs[name][k] = self.code_blobs[name].get(k, []) + v
+                # Add the edges that are not in the graph yet, unknown dependencies are added without dependencies
+                src = self._id(name)
                 for func in v:
-                    # Recursively add each dependency with an empty dependency list
-                    self.add(func, {CodeData.DEP: []})
+                    if func not in self.code_blobs:
+                        self.code_blobs[sys.intern(func)] = CodeBlob()
+                    dst = self._id(func)
+                    edge = (src << 32) | dst
+                    if edge not in self.edges:
+                        self.edges.add(edge)
+                        self.forward.setdefault(src, array('I')).append(dst)
+                        self.reverse.setdefault(dst, array('I')).append(src)
             else:
                 # Update other attributes
-                self.code_blobs[name][k] = v
+                blob[k] = v
+
+        if data.get(CodeData.DOC, '-') != '-':
+            # Recording a doc releases the dependents of the code blob
+            self.complete(name)
+
+    def _id(self, name):
+        """
+        Get the id of a name in the dependency graph, assigning the next one on first use.
+
+        Input:
+            name (str): The name of the code blob.
+
+        Returns:
+            int: The id of the name.
+
+        Raises:
+            None
+        """
+        i = self.ids.get(name)
+        if i is None:
+            i = self.ids[sys.intern(name)] = len(self.names)
+            self.names.append(name)
+        return i
+
+    def deps(self, name):
+        """
+        Get the dependencies of a code blob.
+
+        Input:
+            name (str): The name of the code blob.
+
+        Returns:
+            list: Names of the unique dependencies of `name`, in order of first occurence.
+
+        Raises:
+            None
+        """
+        i = self.ids.get(name)
+        return [self.names[dep] for dep in self.forward.get(i, ())]
+
+    def code(self, name):
+        """
+        Get the code of a code blob.
+
+        In low memory mode the project scan only keeps the position of the code in its file, it is read again from a
+        memory-mapped file every time it is needed, so the files must not be modified while they are documented.
+
+        Input:
+            name (str): The name of the code blob.
+
+        Returns:
+            str: The code of the code blob, '-' if it has no code.
+
+        Raises:
+            OSError: If the file of the code blob can not be read.
+        """
+        blob = self.__getitem__(name)
+        if blob[CodeData.CODE] != '-' or blob[CodeData.SPAN] is None:
+            return blob[CodeData.CODE]
+        start, end = blob[CodeData.SPAN]
+        with open(blob[CodeData.PATH], 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            return read_segment(mm, start, end)
+
+    def node(self, name):
+        """
+        Get the AST node of a code blob, parsing its code on first use (until it is released).
+
+        Nodes are not kept by the project scan (or the parse cache), only the code blobs that are documented need them.
+        The code starts at the `def`/`class` keyword, so decorators are not part of the node and line numbers are relative
+        to the definition. The lines after the first one keep their indentation in the file, which is still valid Python.
+
+        Input:
+            name (str): The name of the code blob.
+
+        Returns:
+            ast.AST: The function/class node, None if the code blob has no code.
+
+        Raises:
+            SyntaxError: If the code of the code blob is not valid Python code.
+        """
+        blob = self.__getitem__(name)
+        if blob[CodeData.NODE] is None:
+            code = self.code(name)
+            if code != '-':
+                blob[CodeData.NODE] = ast.parse(code).body[0]
+        return blob[CodeData.NODE]
+
+    def release(self, name):
+        """
+        Drop the AST node of a processed code blob, it is parsed again from its code if needed.
+
+        Input:
+            name (str): The name of the code blob.
+
+        Returns:
+            None
+
+        Raises:
+            None
+        """
+        blob = self.code_blobs.get(name)
+        if blob is not None:
+            blob[CodeData.NODE] = None
+
+    def custom_dependancies(self, name):
+        """
+        Get the unique custom dependencies of a code blob, ignoring recursive calls.
+
+        Input:
+            name (str): The name of the code blob.
+
+        Returns:
+            list: Names of the custom code blobs that `name` depends on, in order of first occurence.
+
+        Raises:
+            None
+        """
+        return [dep for dep in self.deps(name) if dep != name and self.__getitem__(dep)[CodeData.CUSTOM]]
+
+    def reset_ready(self):
+        """
+        Initialize the readiness tracking of all custom code blobs.
+
+        Counts the unprocessed custom dependencies of every custom code blob and queues the ones without any.
+        Must be called once all code blobs are added and before `pop_ready`/`complete` are used.
+
+        Input:
+            None
+
+        Returns:
+            None
+
+        Raises:
+            None
+        """
+        self.order = {name: i for i, name in enumerate(name for name, info in self.code_blobs.items() if info[CodeData.CUSTOM])}
+        self.pending, self.ready, self.queued, self.processed = {}, [], set(), set()
+
+        for name in self.order:
+            self.pending[name] = len(self.custom_dependancies(name))
+            if self.pending[name] == 0:
+                self._push_ready(name)
+
+    def _push_ready(self, name):
+        """
+        Push a custom code blob to the ready heap, at most once.
+
+        Input:
+            name (str): The name of the code blob.
+
+        Returns:
+            None
+
+        Raises:
+            None
+        """
+        if name not in self.queued:
+            self.queued.add(name)
+            heapq.heappush(self.ready, (self.order[name], name))
+
+    def has_ready(self):
+        """
+        Check if a custom code blob is ready to be documented.
+
+        Input:
+            None
+
+        Returns:
+            bool: True if the ready heap is not empty.
+
+        Raises:
+            None
+        """
+        return len(self.ready) > 0
+
+    def pop_ready(self):
+        """
+        Remove and return the next ready code blob.
+
+        Input:
+            None
+
+        Returns:
+            str: The ready code blob that appears first in the code base.
+
+        Raises:
+            IndexError: If no code blob is ready.
+        """
+        return heapq.heappop(self.ready)[1]
+
+    def force_ready(self):
+        """
+        Queue the unqueued custom code blob with the least pending dependencies to break a dependency cycle.
+
+        Input:
+            None
+
+        Returns:
+            str: The code blob that was queued, None if every custom code blob is already queued.
+
+        Raises:
+            None
+        """
+        candidates = [name for name in self.order if name not in self.queued]
+        if not candidates:
+            return None
+
+        name = min(candidates, key=lambda x: (self.pending[x], self.order[x]))
+        self._push_ready(name)
+        return name
+
+    def complete(self, name):
+        """
+        Mark a custom code blob as processed and queue the dependents whose dependencies are now all processed.
+
+        Input:
+            name (str): The name of the processed code blob.
+
+        Returns:
+            None
+
+        Raises:
+            None
+        """
+        if name not in self.order or name in self.processed:
+            return
+
+        self.processed.add(name)
+        for dependent in map(self.names.__getitem__, self.reverse.get(self.ids.get(name), ())):
+            if dependent in self.pending and dependent != name:
+                self.pending[dependent] -= 1
+                if self.pending[dependent] == 0:
+                    self._push_ready(dependent)
                  
     def dependancies(self, name):
         """
@@ -83,13 +473,12 @@ class CodeData:
             name (str): The name of the code blob to check for dependencies.
     
         Returns:
-            int: The number of dependencies for the specified code blob.
+            int: The number of unique dependencies for the specified code blob.
     
         Raises:
-            KeyError: If the specified code blob name doesn't exist in the code_blobs dictionary.
+            None
         """
-        fobj = self.code_blobs.get(name, {})  # Retrieve the code blob object, default to an empty dictionary if not found
-        return len(fobj.get(CodeData.DEP, []))  # Return the length of the dependencies list, default to empty list if not found
+        return len(self.forward.get(self.ids.get(name), ()))  # Number of unique dependencies, 0 for unknown names
     
     def documented_dependancies(self, name):
         """
@@ -105,8 +494,7 @@ class CodeData:
         KeyError: If accessing an attribute in `self.__getitem__(f)` fails.
     
         """
-        fobj = self.code_blobs.get(name, {})  # Retrieve the code blob object by name, defaulting to an empty dict
-        return len([f for f in fobj.get(CodeData.DEP, []) if self.__getitem__(f)[CodeData.DOC] != '-'])
+        return len([f for f in self.deps(name) if self.__getitem__(f)[CodeData.DOC] != '-'])
         # Count dependencies where the documentation is present (not equal to '-')
             
     def undocumented_dependancies(self, name):
@@ -123,10 +511,9 @@ class CodeData:
         - KeyError: If the code blob name does not exist in self.code_blobs.
         """
         
-        fobj = self.code_blobs.get(name, {})  # Retrieve the code blob object using the provided name
         # Count dependencies that do not have documentation
         return len(
-            [f for f in fobj.get(CodeData.DEP, []) if not self.__getitem__(f)[CodeData.DOC] == '-']
+            [f for f in self.deps(name) if self.__getitem__(f)[CodeData.DOC] == '-']
         )
 
     def items(self):
@@ -302,7 +689,7 @@ def get_reference_docs_custom_functions(func, code_dependancies):
     ref_docs = []  # Initialize an empty list to hold reference documentation
 
     # Iterate over each dependency function for the given function
-    for dep_func in code_dependancies[func][CodeData.DEP]:
+    for dep_func in code_dependancies.deps(func):
         # Check if the dependency function has a short documentation string
         if code_dependancies[dep_func][CodeData.DOC_SHORT] != '-':
             # Append the dependency function and its documentation to the reference documentation list
@@ -330,7 +717,131 @@ def get_summarized_docs(func_name, doc_str, mode, args):
     Raises:
     - ValueError: If any of the inputs are invalid or if the LLM returns an error
     """
-    return get_llm_output(SYSTEM_PROMPT, DOC_SUMMARIZATION_PROMPT(func_name, doc_str), mode, args)
+    return get_llm_output(SYSTEM_PROMPT, DOC_SUMMARIZATION_PROMPT(func_name, doc_str), mode, args)[0]
+
+
+def parse_batched_summaries(out):
+    """
+    Parse the JSON object returned by the LLM for a batched summarization prompt.
+
+    Input:
+    - out (str): The output of the LLM.
+
+    Returns:
+    - dict: Summarized documentation by function name, empty if the output could not be parsed.
+
+    Raises:
+    - None
+    """
+    if '```json' in out:
+        out = out.split('```json')[1]
+    out = out.split('```')[0].strip()
+
+    try:
+        summaries = json.loads(out)
+    except ValueError:
+        # Fall back to the outermost object if the model added text around it
+        match = re.search(r'\{.*\}', out, re.DOTALL)
+        try:
+            summaries = json.loads(match.group(0)) if match else {}
+        except ValueError:
+            summaries = {}
+
+    if not isinstance(summaries, dict):
+        return {}
+    return {func: clean_doc_str(summary) for func, summary in summaries.items() if isinstance(summary, str) and summary.strip()}
+
+
+def get_doc_batches(ref_docs, max_tokens):
+    """
+    Pack reference documentation into batches whose prompts fit a token budget.
+
+    Input:
+    - ref_docs (list of dict): Documentation to summarize, with 'function' and 'doc_str' keys.
+    - max_tokens (int): Maximum (estimated) number of tokens of the documentation in a batch.
+
+    Returns:
+    - list of list of dict: Batches in the original order, a documentation larger than the budget gets its own batch.
+
+    Raises:
+    - None
+    """
+    batches, batch, batch_tokens = [], [], 0
+    for ref_doc in ref_docs:
+        num_tokens = estimate_tokens(format_docs([ref_doc]))
+        if batch and batch_tokens + num_tokens > max_tokens:
+            batches.append(batch)
+            batch, batch_tokens = [], 0
+        batch.append(ref_doc)
+        batch_tokens += num_tokens
+
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def summarize_doc_batch(batch, mode, args):
+    """
+    Summarize a batch of documentation with a single LLM request.
+
+    Functions missing from the response of the LLM are summarized with individual requests.
+
+    Input:
+    - batch (list of dict): Documentation to summarize, with 'function' and 'doc_str' keys.
+    - mode (str): The mode in which the LLM should operate.
+    - args (Namespace): Additional arguments to be passed to the LLM.
+
+    Returns:
+    - dict: Summarized documentation by function name.
+
+    Raises:
+    - Exception: If the LLM could not be reached.
+    """
+    with get_metrics().stage(SUMMARIZATION):
+        if len(batch) == 1:
+            return {batch[0]['function']: get_summarized_docs(batch[0]['function'], batch[0]['doc_str'], mode, args)}
+
+        out, _ = get_llm_output(SYSTEM_PROMPT, DOC_BATCH_SUMMARIZATION_PROMPT(batch), mode, args)
+        summaries = parse_batched_summaries(out)
+
+        summaries = {ref_doc['function']: summaries[ref_doc['function']] for ref_doc in batch if ref_doc['function'] in summaries}
+        missing = [ref_doc for ref_doc in batch if ref_doc['function'] not in summaries]
+        if missing:
+            logging.debug(f'Batched summary is missing {len(missing)}/{len(batch)} functions, summarizing them individually')
+        for ref_doc in missing:
+            summaries[ref_doc['function']] = get_summarized_docs(ref_doc['function'], ref_doc['doc_str'], mode, args)
+
+        return summaries
+
+
+def get_batched_summarized_docs(func_names, doc_strs, mode, args):
+    """
+    Summarize the documentation of many functions, packing several of them into each LLM request.
+
+    Input:
+    - func_names (list of str): Names of the functions.
+    - doc_strs (list of str): Documentation of each function, '-' if there is none.
+    - mode (str): The mode in which the LLM should operate.
+    - args (Namespace): Additional arguments, including summarize_batch_tokens and jobs.
+
+    Returns:
+    - list of str: The summarized documentation of each function, '-' (or the empty documentation) is kept as is.
+
+    Raises:
+    - Exception: If the LLM could not be reached.
+    """
+    ref_docs = [{'function': func, 'doc_str': doc} for func, doc in zip(func_names, doc_strs) if doc and doc != '-']
+    batches = get_doc_batches(ref_docs, args.summarize_batch_tokens)
+    logging.info(f'Summarizing {len(ref_docs)} reference docs in {len(batches)} requests')
+
+    summaries = {}
+    with ThreadPoolExecutor(max_workers=args.jobs) as executor:
+        for i, batch_summaries in enumerate(executor.map(lambda batch: summarize_doc_batch(batch, mode, args), batches)):
+            summaries.update(batch_summaries)
+            if len(batches) <= 10 or (i + 1) % (round(len(batches) / 10)) == 0:
+                logging.info(f'\t[{i+1}/{len(batches)}] {round(100*(i+1)/len(batches))}% done')
+
+    return [summaries.get(func, doc) for func, doc in zip(func_names, doc_strs)]
 
 
 def get_truncated_docs(func_name, doc_str):
@@ -380,13 +891,14 @@ def get_shortened_docs(func_name, doc_str, mode, llm_mode, args):
         # Return the original if it's empty or just a dash
         return doc_str
 
-    if mode == 'summarize':
-        return get_summarized_docs(func_name, doc_str, llm_mode, args)
-    elif mode == 'truncate':
-        return get_truncated_docs(func_name, doc_str)
-    elif mode == 'full':
-        return doc_str
-    else:
-        # Log a warning if an unknown mode is specified and default to truncation
-        logging.warning(f'Could not shorten doc for `{func_name}` using mode: `{mode}`, using truncation')
-        return get_truncated_docs(func_name, doc_str)
\ No newline at end of file
+    with get_metrics().stage(SUMMARIZATION):
+        if mode == 'summarize':
+            return get_summarized_docs(func_name, doc_str, llm_mode, args)
+        elif mode == 'truncate':
+            return get_truncated_docs(func_name, doc_str)
+        elif mode == 'full':
+            return doc_str
+        else:
+            # Log a warning if an unknown mode is specified and default to truncation
+            logging.warning(f'Could not shorten doc for `{func_name}` using mode: `{mode}`, using truncation')
+            return get_truncated_docs(func_name, doc_str)
\ No newline at end of file
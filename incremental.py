@@ -0,0 +1,109 @@
+import hashlib
+import logging
+import json
+import os
+
+
+MANIFEST_NAME = '.lmdocs_manifest.json'
+
+
+def get_manifest_path(project_path, manifest_path=None):
+    """
+    Get the path of the incremental manifest of a project.
+
+    Input:
+        project_path (str): Path to the file/folder of the project.
+        manifest_path (str): Explicit manifest path, used as is if given.
+
+    Returns:
+        str: Path of the manifest, stored at the root of the project by default.
+
+    Raises:
+        None
+    """
+    if manifest_path:
+        return manifest_path
+    root = project_path if os.path.isdir(project_path) else os.path.dirname(project_path)
+    return os.path.join(root, MANIFEST_NAME)
+
+
+def get_manifest_key(project_path, func_path, func_name):
+    """
+    Get the key of a function in the manifest.
+
+    Input:
+        project_path (str): Path to the file/folder of the project.
+        func_path (str): Path of the file containing the function.
+        func_name (str): Name of the function/method/class.
+
+    Returns:
+        str: `<path relative to the project>::<name>`, independent of where the project is checked out.
+
+    Raises:
+        None
+    """
+    root = project_path if os.path.isdir(project_path) else os.path.dirname(project_path)
+    return f'{os.path.relpath(func_path, root or ".")}::{func_name}'
+
+
+def hash_ref_docs(ref_docs):
+    """
+    Hash the reference documentation used in the prompt of a function.
+
+    Input:
+        ref_docs (list of dict): Reference documentation with 'function' and 'doc_str' keys.
+
+    Returns:
+        str: SHA-256 hex digest of the reference documentation.
+
+    Raises:
+        None
+    """
+    return hashlib.sha256(json.dumps(ref_docs).encode('utf-8')).hexdigest()
+
+
+def load_manifest(manifest_path):
+    """
+    Load the manifest written by a previous incremental run.
+
+    Input:
+        manifest_path (str): Path of the manifest.
+
+    Returns:
+        dict: Manifest entries by key, empty if there is no (readable) manifest.
+
+    Raises:
+        None
+    """
+    if not os.path.exists(manifest_path):
+        logging.info(f'No manifest found at `{manifest_path}`, documenting all functions')
+        return {}
+
+    try:
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+    except (OSError, ValueError) as e:
+        logging.warning(f'Could not read manifest `{manifest_path}` ({e}), documenting all functions')
+        return {}
+
+    logging.info(f'Loaded {len(manifest)} entries from manifest `{manifest_path}`')
+    return manifest
+
+
+def save_manifest(manifest_path, manifest):
+    """
+    Write the manifest for the next incremental run.
+
+    Input:
+        manifest_path (str): Path of the manifest.
+        manifest (dict): Manifest entries by key, each with the keys path, name, hash, code_hash, ref_hash, doc, doc_short and code_new.
+
+    Returns:
+        None
+
+    Raises:
+        OSError: If the manifest can not be written.
+    """
+    with open(manifest_path, 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    logging.info(f'Saved {len(manifest)} entries to manifest `{manifest_path}`')
@@ -0,0 +1,192 @@
+import threading
+import hashlib
+import logging
+import sqlite3
+import json
+import time
+import os
+
+
+class LLMCache:
+    def __init__(self, path, max_size_mb, model):
+        """
+        Initializes a persistent, size bounded cache of LLM responses stored in an SQLite database.
+
+        Input:
+            path (str): Path of the SQLite database, created if it does not exist.
+            max_size_mb (float): Maximum size of the cached responses in MB, least recently used entries are evicted first.
+            model (str): Name of the model whose responses are cached, part of every cache key.
+
+        Returns:
+            None
+
+        Raises:
+            sqlite3.Error: If the database can not be opened.
+        """
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        self.path = path
+        self.max_size = int(max_size_mb * 1024 * 1024)
+        self.model = model
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()  # Responses are cached from multiple worker threads
+
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, output TEXT, size INTEGER, last_access REAL)')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS cache_last_access ON cache (last_access)')
+        self.conn.commit()
+        self.size = self.conn.execute('SELECT COALESCE(SUM(size), 0) FROM cache').fetchone()[0]
+
+    def make_key(self, temperature, max_tokens, system_prompt, prompt, attempt=0):
+        """
+        Compute the content address of an LLM request.
+
+        Input:
+            temperature (float): Sampling temperature of the request.
+            max_tokens (int): Maximum number of tokens of the request.
+            system_prompt (str): The system prompt of the request.
+            prompt (str): The user prompt of the request.
+            attempt (int): Index of the attempt, so that retries of the same prompt get different responses.
+
+        Returns:
+            str: SHA-256 hex digest identifying the request.
+
+        Raises:
+            None
+        """
+        payload = json.dumps([self.model, temperature, max_tokens, system_prompt, prompt, attempt])
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        """
+        Look up a cached response and mark it as recently used.
+
+        Input:
+            key (str): The key returned by `make_key`.
+
+        Returns:
+            str: The cached response, None if the key is not cached.
+
+        Raises:
+            None
+        """
+        with self.lock:
+            row = self.conn.execute('SELECT output FROM cache WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            self.conn.execute('UPDATE cache SET last_access = ? WHERE key = ?', (time.time(), key))
+            self.conn.commit()
+            return row[0]
+
+    def put(self, key, output):
+        """
+        Store a response and evict the least recently used responses if the cache grows too large.
+
+        Input:
+            key (str): The key returned by `make_key`.
+            output (str): The response of the LLM.
+
+        Returns:
+            None
+
+        Raises:
+            None
+        """
+        size = len(output.encode('utf-8'))
+        with self.lock:
+            row = self.conn.execute('SELECT size FROM cache WHERE key = ?', (key,)).fetchone()
+            self.size += size - (row[0] if row else 0)
+            self.conn.execute('INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?)', (key, output, size, time.time()))
+
+            # Evict the least recently used responses in batches until the cache fits
+            while self.size > self.max_size:
+                rows = self.conn.execute('SELECT key, size FROM cache ORDER BY last_access LIMIT 64').fetchall()
+                if not rows:
+                    break
+                self.conn.executemany('DELETE FROM cache WHERE key = ?', [(k,) for k, _ in rows])
+                self.size -= sum(s for _, s in rows)
+
+            self.conn.commit()
+
+    def stats(self):
+        """
+        Get a printable summary of the cache usage.
+
+        Input:
+            None
+
+        Returns:
+            str: Number of cache hits and misses.
+
+        Raises:
+            None
+        """
+        return f'cache_hits: {self.hits}, cache_misses: {self.misses}'
+
+    def close(self):
+        """
+        Close the underlying database.
+
+        Input:
+            None
+
+        Returns:
+            None
+
+        Raises:
+            None
+        """
+        with self.lock:
+            self.conn.close()
+
+
+CACHE = None
+
+
+def init_cache(args, model):
+    """
+    Open the shared LLM response cache unless it is disabled with --no_cache.
+
+    Input:
+        args (Namespace): Arguments containing no_cache, cache_path and cache_size.
+        model (str): Name of the LLM whose responses are cached.
+
+    Returns:
+        LLMCache: The shared cache, None if caching is disabled.
+
+    Raises:
+        None
+    """
+    global CACHE
+    if CACHE is not None:
+        CACHE.close()
+        CACHE = None
+
+    if args.no_cache:
+        logging.info('LLM response cache disabled')
+        return None
+
+    CACHE = LLMCache(args.cache_path, args.cache_size, model)
+    logging.info(f'Using LLM response cache: {args.cache_path}')
+    return CACHE
+
+
+def get_cache():
+    """
+    Get the shared LLM response cache.
+
+    Input:
+        None
+
+    Returns:
+        LLMCache: The shared cache, None if `init_cache` was not called or caching is disabled.
+
+    Raises:
+        None
+    """
+    return CACHE
@@ -1,11 +1,522 @@
-from constants import MAX_TOKENS, TEMPERATURE,STOP_TOKENS, OPENAI, LOCAL, TOK_COUNT
+from constants import MAX_TOKENS, TEMPERATURE,STOP_TOKENS, OPENAI, LOCAL, TOK_COUNT, CONNECT_TIMEOUT, READ_TIMEOUT, BACKOFF_BASE, BACKOFF_MAX, ENDPOINT_RECHECK_INTERVAL, OPENAI_URL
 from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, CancelledError, as_completed
+from requests.adapters import HTTPAdapter
+from llm_cache import get_cache
+from prompts import estimate_tokens
+from metrics import get_metrics
+import threading
 import logging
 import requests
+import random
+import time
 import os
+import re
 import json
 
 
+CHAT_COMPLETIONS_PATH = '/v1/chat/completions'
+
+
+class TransientAPIError(Exception):
+    def __init__(self, message, retry_after=None, status=None):
+        """
+        Error for LLM requests that may succeed when retried (rate limits, server errors, timeouts).
+
+        Input:
+            message (str): Description of the error.
+            retry_after (float): Seconds to wait before retrying as requested by the server, None if unknown.
+            status (int): HTTP status code of the response, None if there was no response.
+
+        Returns:
+            None
+
+        Raises:
+            None
+        """
+        super().__init__(message)
+        self.retry_after = retry_after
+        self.status = status
+
+
+class TokenBucket:
+    def __init__(self, per_minute):
+        """
+        Initializes a token bucket that refills continuously up to a per minute budget.
+
+        Input:
+            per_minute (float): Budget per minute, also the capacity of the bucket.
+
+        Returns:
+            None
+
+        Raises:
+            None
+        """
+        self.capacity = per_minute
+        self.rate = per_minute / 60
+        self.tokens = per_minute
+        self.updated = time.monotonic()
+
+    def wait_time(self, amount, now):
+        """
+        Get the time until `amount` can be consumed from the bucket.
+
+        Input:
+            amount (float): Amount to consume, capped at the capacity of the bucket.
+            now (float): Current value of `time.monotonic()`.
+
+        Returns:
+            float: Seconds to wait, 0 if the amount is available.
+
+        Raises:
+            None
+        """
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        amount = min(amount, self.capacity)
+        return 0 if self.tokens >= amount else (amount - self.tokens) / self.rate
+
+    def consume(self, amount):
+        """
+        Remove `amount` from the bucket.
+
+        Input:
+            amount (float): Amount to consume, capped at the capacity of the bucket.
+
+        Returns:
+            None
+
+        Raises:
+            None
+        """
+        self.tokens -= min(amount, self.capacity)
+
+
+class RateLimiter:
+    def __init__(self, requests_per_minute=None, tokens_per_minute=None):
+        """
+        Initializes a rate limiter shared by all LLM requests.
+
+        Input:
+            requests_per_minute (float): Maximum requests per minute, None for no limit.
+            tokens_per_minute (float): Maximum (estimated) tokens per minute, None for no limit.
+
+        Returns:
+            None
+
+        Raises:
+            None
+        """
+        self.requests = TokenBucket(requests_per_minute) if requests_per_minute else None
+        self.tokens = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        self.blocked_until = 0  # Set when the server asks to back off
+        self.lock = threading.Lock()
+
+    def acquire(self, num_tokens):
+        """
+        Block until a request using `num_tokens` tokens fits in the budgets, then consume them.
+
+        Input:
+            num_tokens (int): Estimated number of tokens (prompt and completion) of the request.
+
+        Returns:
+            None
+
+        Raises:
+            None
+        """
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                wait = max(
+                    self.blocked_until - now,
+                    self.requests.wait_time(1, now) if self.requests else 0,
+                    self.tokens.wait_time(num_tokens, now) if self.tokens else 0,
+                )
+                if wait <= 0:
+                    if self.requests:
+                        self.requests.consume(1)
+                    if self.tokens:
+                        self.tokens.consume(num_tokens)
+                    return
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        """
+        Hold back all requests for the given time.
+
+        Input:
+            seconds (float): Seconds to wait before the next request is sent.
+
+        Returns:
+            None
+
+        Raises:
+            None
+        """
+        with self.lock:
+            self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+
+def parse_duration(value):
+    """
+    Parse a duration from a rate limit header.
+
+    Input:
+        value (str): Seconds (e.g. `20`) or a duration like `1m30s`, `6m0s` or `250ms`.
+
+    Returns:
+        float: The duration in seconds, None if it could not be parsed.
+
+    Raises:
+        None
+    """
+    if not value:
+        return None
+
+    try:
+        return float(value)
+    except ValueError:
+        pass
+
+    parts = re.findall(r'([\d.]+)(ms|s|m|h)', value)
+    if not parts:
+        return None
+    scale = {'ms': 0.001, 's': 1, 'm': 60, 'h': 3600}
+    return sum(float(num) * scale[unit] for num, unit in parts)
+
+
+def get_retry_after(r):
+    """
+    Get the time a server asks to wait before the next request from the response headers.
+
+    Input:
+        r (requests.Response): The response of the LLM API.
+
+    Returns:
+        float: Seconds to wait, None if the response does not say.
+
+    Raises:
+        None
+    """
+    retry_after = parse_duration(r.headers.get('Retry-After'))
+    if retry_after is not None:
+        return retry_after
+
+    # OpenAI reports when the exhausted request/token budget resets
+    resets = [
+        parse_duration(r.headers.get(f'x-ratelimit-reset-{kind}'))
+        for kind in ['requests', 'tokens']
+        if r.headers.get(f'x-ratelimit-remaining-{kind}') == '0'
+    ]
+    resets = [reset for reset in resets if reset is not None]
+    return max(resets) if resets else None
+
+
+def check_response(r):
+    """
+    Raise an error for unsuccessful LLM API responses.
+
+    Input:
+        r (requests.Response): The response of the LLM API.
+
+    Returns:
+        None
+
+    Raises:
+        TransientAPIError: For rate limits (429) and server errors (5xx).
+        Exception: For any other unsuccessful status code.
+    """
+    if r.status_code == 200:
+        return
+
+    message = f'HTTP {r.status_code}: {r.text[:200]}'
+    r.close()
+    if r.status_code == 429 or r.status_code >= 500:
+        raise TransientAPIError(message, get_retry_after(r), r.status_code)
+    raise Exception(message)
+
+
+class EndpointPool:
+    def __init__(self, base_urls, recheck_interval=ENDPOINT_RECHECK_INTERVAL):
+        """
+        Initializes a pool of LLM servers that spreads requests by least outstanding requests.
+
+        Input:
+            base_urls (list of str): Base URLs of the servers, e.g. `http://localhost:8080`.
+            recheck_interval (float): Seconds before a failed server is health checked again.
+
+        Returns:
+            None
+
+        Raises:
+            None
+        """
+        self.base_urls = base_urls
+        self.recheck_interval = recheck_interval
+        self.outstanding = [0] * len(base_urls)
+        self.healthy = [True] * len(base_urls)
+        self.recheck_at = [0] * len(base_urls)
+        self.lock = threading.Lock()
+
+    def health_check(self):
+        """
+        Check every server through /v1/models and take the failing ones out of rotation.
+
+        Input:
+            None
+
+        Returns:
+            list of str: Name of the model served by each healthy server.
+
+        Raises:
+            Exception: If none of the servers is healthy.
+        """
+        models = []
+        for i, base_url in enumerate(self.base_urls):
+            try:
+                models.append(get_local_llm_name(base_url))
+                self.healthy[i] = True
+            except Exception as e:
+                logging.warning(f'Taking `{base_url}` out of rotation: {e}')
+                self.healthy[i] = False
+                self.recheck_at[i] = time.monotonic() + self.recheck_interval
+
+        if not models:
+            raise Exception(f'None of the LLM servers are reachable: {self.base_urls}')
+        return models
+
+    def recheck(self):
+        """
+        Health check the failed servers whose re-check interval passed, bringing them back into rotation if they respond.
+
+        Input:
+            None
+
+        Returns:
+            None
+
+        Raises:
+            None
+        """
+        now = time.monotonic()
+        with self.lock:
+            # Claim the due servers so that only one thread checks each of them
+            due = [i for i in range(len(self.base_urls)) if not self.healthy[i] and self.recheck_at[i] <= now]
+            for i in due:
+                self.recheck_at[i] = now + self.recheck_interval
+
+        for i in due:
+            try:
+                get_local_llm_name(self.base_urls[i])
+            except Exception:
+                continue
+            logging.info(f'Bringing `{self.base_urls[i]}` back into rotation')
+            with self.lock:
+                self.healthy[i] = True
+
+    def acquire(self):
+        """
+        Pick the healthy server with the least outstanding requests.
+
+        Input:
+            None
+
+        Returns:
+            int: Index of the server, to be passed to `url` and `release`.
+
+        Raises:
+            TransientAPIError: If no server is healthy.
+        """
+        if not all(self.healthy):
+            self.recheck()
+
+        with self.lock:
+            candidates = [i for i in range(len(self.base_urls)) if self.healthy[i]]
+            if not candidates:
+                raise TransientAPIError('No healthy LLM server', max(0, min(self.recheck_at) - time.monotonic()))
+            i = min(candidates, key=lambda i: self.outstanding[i])
+            self.outstanding[i] += 1
+            return i
+
+    def release(self, i, failed=False):
+        """
+        Mark a request to a server as done.
+
+        Input:
+            i (int): Index of the server returned by `acquire`.
+            failed (bool): True if the server failed, it is taken out of rotation unless it is the last healthy one.
+
+        Returns:
+            None
+
+        Raises:
+            None
+        """
+        with self.lock:
+            self.outstanding[i] -= 1
+            if failed and self.healthy[i] and sum(self.healthy) > 1:
+                logging.warning(f'Taking `{self.base_urls[i]}` out of rotation for {self.recheck_interval}s')
+                self.healthy[i] = False
+                self.recheck_at[i] = time.monotonic() + self.recheck_interval
+
+    def url(self, i, path):
+        """
+        Get the URL of an API path on a server.
+
+        Input:
+            i (int): Index of the server.
+            path (str): API path, e.g. `/v1/chat/completions`.
+
+        Returns:
+            str: The full URL.
+
+        Raises:
+            None
+        """
+        return self.base_urls[i] + path
+
+
+def get_endpoint_urls(args):
+    """
+    Get the base URLs of the LLM servers from the command line arguments.
+
+    Input:
+        args (Namespace): Arguments containing port and endpoint.
+
+    Returns:
+        list of str: Base URLs of the local servers, the OpenAI API if there are none.
+
+    Raises:
+        None
+    """
+    base_urls = [f'http://localhost:{port}' for port in args.port or []]
+    # Endpoints may be given with or without the API version
+    base_urls += [re.sub(r'/v1/?$', '', endpoint.rstrip('/')) for endpoint in args.endpoint or []]
+    return base_urls if base_urls else [OPENAI_URL]
+
+
+class LLMClient:
+    def __init__(self, max_connections=10, connect_timeout=CONNECT_TIMEOUT, read_timeout=READ_TIMEOUT, requests_per_minute=None, tokens_per_minute=None, base_urls=None):
+        """
+        Initializes an HTTP client that reuses keep-alive connections across LLM requests.
+
+        Input:
+            max_connections (int): Maximum number of pooled connections per host.
+            connect_timeout (float): Seconds to wait while establishing a connection.
+            read_timeout (float): Seconds to wait for the server to send a response.
+            requests_per_minute (float): Maximum requests per minute, None for no limit.
+            tokens_per_minute (float): Maximum (estimated) tokens per minute, None for no limit.
+            base_urls (list of str): Base URLs of the LLM servers requests are spread over, the OpenAI API by default.
+
+        Returns:
+            None
+
+        Raises:
+            None
+        """
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=max_connections, pool_maxsize=max_connections, pool_block=True)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.timeout = (connect_timeout, read_timeout)
+        self.rate_limiter = RateLimiter(requests_per_minute, tokens_per_minute)
+        self.endpoints = EndpointPool(base_urls or [OPENAI_URL])
+
+    def get(self, url, **kwargs):
+        """
+        Send a GET request using a pooled connection.
+
+        Input:
+            url (str): The URL to request.
+            **kwargs: Additional arguments passed to `requests.Session.get`.
+
+        Returns:
+            requests.Response: The response of the server.
+
+        Raises:
+            requests.RequestException: If the request fails or times out.
+        """
+        return self.session.get(url, timeout=self.timeout, **kwargs)
+
+    def post(self, url, **kwargs):
+        """
+        Send a POST request using a pooled connection.
+
+        Input:
+            url (str): The URL to request.
+            **kwargs: Additional arguments passed to `requests.Session.post`.
+
+        Returns:
+            requests.Response: The response of the server.
+
+        Raises:
+            requests.RequestException: If the request fails or times out.
+        """
+        return self.session.post(url, timeout=self.timeout, **kwargs)
+
+    def close(self):
+        """
+        Close all pooled connections.
+
+        Input:
+            None
+
+        Returns:
+            None
+
+        Raises:
+            None
+        """
+        self.session.close()
+
+
+CLIENT = None
+
+
+def init_client(args):
+    """
+    Create the shared LLM client from the command line arguments.
+
+    Input:
+        args (Namespace): Arguments containing port, endpoint, max_connections, connect_timeout, read_timeout, rpm, tpm, jobs and candidates.
+
+    Returns:
+        LLMClient: The shared client used by all LLM requests.
+
+    Raises:
+        None
+    """
+    global CLIENT
+    if CLIENT is not None:
+        CLIENT.close()
+
+    # Every worker should be able to hold a connection for each of its candidates
+    max_connections = args.max_connections if args.max_connections else args.jobs * args.candidates
+    CLIENT = LLMClient(max_connections, args.connect_timeout, args.read_timeout, args.rpm, args.tpm, get_endpoint_urls(args))
+    return CLIENT
+
+
+def get_client():
+    """
+    Get the shared LLM client, creating one with default settings if `init_client` was not called.
+
+    Input:
+        None
+
+    Returns:
+        LLMClient: The shared client used by all LLM requests.
+
+    Raises:
+        None
+    """
+    global CLIENT
+    if CLIENT is None:
+        CLIENT = LLMClient()
+    return CLIENT
+
+
 def clean_output(out):
     """
     Cleans the output string by removing any content following stop tokens.
@@ -25,12 +536,94 @@ def clean_output(out):
     return out.strip()
 
 
-def get_local_llm_name(port):
+def is_complete_output(out):
+    """
+    Check if a (partial) LLM output is complete, i.e. it contains a stop token or a closed code block.
+
+    Input:
+    - out (str): The output generated so far.
+
+    Returns:
+    - bool: True if the rest of the output can be discarded.
+
+    Raises:
+    - None: This function does not raise any exceptions.
+    """
+    if any(tok in out for tok in STOP_TOKENS):
+        return True
+
+    # The prompt already opens the code block, so the first fence closes it unless the output re-opens it, e.g. after
+    # a preamble (`Here is the code:\n```python`)
+    first = out.find('```')
+    if first == -1:
+        return False
+    rest = out[first + 3:]
+    if not rest:
+        # Wait for the next characters, which tell whether the fence opens a code block
+        return False
+    opens = not out[:first].strip() or not rest[0].isspace()
+    return not opens or '```' in rest
+
+
+# Characters that can complete a code block or a stop token, only chunks containing one are checked
+COMPLETION_CHARS = set('`') | set(tok[-1] for tok in STOP_TOKENS)
+
+
+def read_streamed_output(r, cancel=None):
+    """
+    Read a streamed (server-sent events) chat completion, closing the request as soon as the output is complete.
+
+    Input:
+    - r (requests.Response): The streamed response of the LLM API.
+    - cancel (threading.Event): Stop reading once it is set, None to read the whole output.
+
+    Returns:
+    - tuple: The output text and a Counter with the token usage.
+      If the server did not report the usage, the number of received chunks is used as completion tokens.
+
+    Raises:
+    - None
+    """
+    output, usage, num_chunks = '', TOK_COUNT.copy(), 0
+    try:
+        for line in r.iter_lines(decode_unicode=True):
+            if not line or not line.startswith('data:'):
+                continue
+
+            data = line[len('data:'):].strip()
+            if data == '[DONE]':
+                break
+
+            chunk = json.loads(data)
+            if chunk.get('usage'):
+                usage = Counter(chunk['usage'])
+
+            content = ''.join(choice.get('delta', {}).get('content') or '' for choice in chunk.get('choices', []))
+            if content:
+                fence_pending = output.endswith('`')  # A fence at the end of the output is only decided by the next chunk
+                output += content
+                num_chunks += 1
+                # Stop reading once the model closed the code block or emitted a stop token
+                if (fence_pending or COMPLETION_CHARS.intersection(content)) and is_complete_output(output):
+                    break
+            if cancel is not None and cancel.is_set():
+                break
+    finally:
+        r.close()
+
+    if not usage['completion_tokens']:
+        usage['completion_tokens'] = num_chunks
+        usage['total_tokens'] = usage['prompt_tokens'] + num_chunks
+
+    return output, usage
+
+
+def get_local_llm_name(base_url):
     """
-    Retrieve the local LLM (Large Language Model) name from a given port.
+    Retrieve the local LLM (Large Language Model) name from a given server.
 
     Input:
-    port (int): The port number to query the local server for LLM models.
+    base_url (str): Base URL of the local server, e.g. `http://localhost:8080`.
 
     Returns:
     str: The name of the first local LLM model if available, otherwise returns '-'.
@@ -38,19 +631,19 @@ def get_local_llm_name(port):
     Raises:
     Exception: If there is any error while accessing the local server endpoint or processing the response.
     """
-    r = requests.get(f'http://localhost:{port}/v1/models')
     output = '-'
     try:
+        r = get_client().get(f'{base_url}/v1/models')
         # Attempt to extract the model name from the response
         output = r.json()['data'][0]['id']
     except Exception as e:
         # Raise an exception if there's an error in the request or response processing
-        raise Exception(f'Error while accessing http://localhost:{port}/v1/models: {e}')
+        raise Exception(f'Error while accessing {base_url}/v1/models: {e}')
     
     return output
     
 
-def get_llm_api_output(url, headers, model, system_prompt, prompt, temperature, max_tokens):
+def get_llm_api_output(url, headers, model, system_prompt, prompt, temperature, max_tokens, stream=False, n=1, cancel=None):
     """
     Sends a POST request to an LLM API and processes the response.
 
@@ -62,82 +655,341 @@ def get_llm_api_output(url, headers, model, system_prompt, prompt, temperature,
         prompt (str): The user's content in the message sequence.
         temperature (float): Sampling temperature for the generation.
         max_tokens (int): Maximum number of tokens to generate.
+        stream (bool): Stream the completion and stop reading it once the code block is closed (only used if n is 1).
+        n (int): Number of completions to generate for the prompt.
+        cancel (threading.Event): Stop reading a streamed completion once it is set.
 
     Returns:
         tuple: A tuple containing two elements:
-            - output (str): The cleaned output text from the API response.
-            - usage (Counter): A Counter object representing the token usage.
+            - outputs (list of str): The cleaned output texts from the API response, one per completion.
+            - usage (Counter): A Counter object representing the token usage of all completions.
 
     Raises:
+        TransientAPIError: If the request was rate limited, timed out or failed on the server.
         Exception: If there is an error accessing the URL or processing the response.
     """
     
     # Initialize usage counter with a copy of TOK_COUNT
     usage = TOK_COUNT.copy()
     
-    # Send POST request to the LLM API endpoint
-    r = requests.post(
-        url, 
-        headers=headers,
-        json={
-            "model": model,
-            "messages": [ 
-                { "role": "system", "content": system_prompt },
-                { "role": "user", "content": prompt },
-            ], 
-            "temperature": temperature, 
-            "max_tokens": max_tokens,
-            "stream": False,
-            "stop": STOP_TOKENS,
-        }
-    )
-    
-    output = '-'
+    payload = {
+        "model": model,
+        "messages": [ 
+            { "role": "system", "content": system_prompt },
+            { "role": "user", "content": prompt },
+        ], 
+        "temperature": temperature, 
+        "max_tokens": max_tokens,
+        "stream": stream,
+        "stop": STOP_TOKENS,
+    }
+    if n > 1:
+        payload["n"] = n
+    if stream:
+        # Ask for the token usage in the last chunk (used if the output does not end early)
+        payload["stream_options"] = {"include_usage": True}
+
+    outputs = ['-']
     try:
-        # Extract the output content and usage statistics from the response
-        output = r.json()['choices'][0]['message']['content'].lstrip('\n').strip('\n').strip()
-        usage = Counter(r.json()['usage'])
+        # Send POST request to the LLM API endpoint over a pooled connection
+        r = get_client().post(url, headers=headers, json=payload, stream=stream)
+        check_response(r)
+        
+        if stream:
+            output, usage = read_streamed_output(r, cancel)
+            outputs = [output.lstrip('\n').strip('\n').strip()]
+        else:
+            # Extract the output contents and usage statistics from the response
+            response = r.json()
+            choices = sorted(response['choices'], key=lambda choice: choice.get('index', 0))
+            outputs = [choice['message']['content'].lstrip('\n').strip('\n').strip() for choice in choices]
+            usage = Counter(response['usage'])
+    except TransientAPIError:
+        raise
+    except (requests.ConnectionError, requests.Timeout) as e:
+        raise TransientAPIError(f'Error while accessing {url}: {e}')
     except Exception as e:
         # Raise an exception if there is an error processing the response
         raise Exception(f'Error while accessing {url}: {e}')
         
-    return clean_output(output), usage
+    # Honor rate limit headers of successful responses as well
+    retry_after = get_retry_after(r)
+    if retry_after:
+        get_client().rate_limiter.pause(retry_after)
 
+    return [clean_output(output) for output in outputs], usage
 
-def get_llm_output(system_prompt, prompt, mode, args):
+
+def get_llm_api_output_with_retries(path, headers, model, system_prompt, prompt, args, n=1, cancel=None):
     """
-    Generates the output from a language model based on given prompts and configuration.
+    Send an LLM request within the rate limits, retrying transient failures with jittered exponential backoff.
+
+    Every attempt is sent to the LLM server with the least outstanding requests.
+
+    Input:
+        path (str): The API path of the LLM endpoint, e.g. `/v1/chat/completions`.
+        headers (dict): HTTP headers to include in the request.
+        model (str): The model name to be used for the request.
+        system_prompt (str): The system role's content in the message sequence.
+        prompt (str): The user's content in the message sequence.
+        args (Namespace): Arguments containing temperature, max_tokens, stream and api_retries.
+        n (int): Number of completions to generate for the prompt, completions are not streamed if it is more than 1.
+        cancel (threading.Event): Give up once it is set, None if the request can not be cancelled.
+
+    Returns:
+        tuple: The cleaned output texts and a Counter with the token usage.
+
+    Raises:
+        CancelledError: If `cancel` was set before the request succeeded.
+        Exception: If the request failed permanently or still failed after `args.api_retries` retries.
+    """
+    rate_limiter, endpoints = get_client().rate_limiter, get_client().endpoints
+    # Completion tokens count towards the token budget as soon as the request is sent
+    num_tokens = estimate_tokens(system_prompt) + estimate_tokens(prompt) + n * args.max_tokens
+
+    for retry in range(args.api_retries + 1):
+        rate_limiter.acquire(num_tokens)
+        if cancel is not None and cancel.is_set():
+            raise CancelledError('LLM request was cancelled')
+        try:
+            endpoint = endpoints.acquire()
+            try:
+                output = get_llm_api_output(
+                    endpoints.url(endpoint, path), headers, model, system_prompt, prompt,
+                    args.temperature, args.max_tokens, args.stream and n == 1, n, cancel,
+                )
+            except TransientAPIError as e:
+                # Rate limits are not a failure of the server
+                endpoints.release(endpoint, failed=e.status != 429)
+                raise
+            except Exception:
+                endpoints.release(endpoint)
+                raise
+            endpoints.release(endpoint)
+            return output
+        except TransientAPIError as e:
+            if retry == args.api_retries:
+                raise Exception(f'Giving up after {args.api_retries} retries: {e}')
+
+            if e.retry_after is not None:
+                # The server asked every request to wait
+                delay = e.retry_after
+                rate_limiter.pause(delay)
+            else:
+                delay = random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** retry))
+
+            logging.warning(f'{e}. Retrying in {delay:.1f}s ({retry+1}/{args.api_retries})')
+            get_metrics().add(api_retries=1)
+            if cancel is not None:
+                cancel.wait(delay)
+            else:
+                time.sleep(delay)
+
+
+def get_request_config(mode, args):
+    """
+    Get the headers and model name of LLM requests.
 
     Input:
-        system_prompt (str): The system prompt to guide the model's behavior.
-        prompt (str): The user prompt for which the model will generate a response.
         mode (str): The mode of model usage, either 'OPENAI' for OpenAI's API or 'LOCAL' for a local model.
-        args (Namespace): An object containing necessary arguments, such as API keys, model settings, and other configurations.
+        args (Namespace): An object containing necessary arguments, such as API keys and model settings.
 
     Returns:
-        dict: A dictionary containing the API response from the language model.
+        tuple: The HTTP headers and the model name.
 
     Raises:
         Exception: If the 'mode' is neither 'OPENAI' nor 'LOCAL'.
     """
-    
     if mode == OPENAI:
         # Use the OpenAI API key from args; fallback to environment variable if not provided
         openai_key = args.openai_key if args.openai_key else os.environ[args.openai_key_env]
-        url = 'https://api.openai.com/v1/chat/completions'
         headers={
             "Content-Type": "application/json",
             "Authorization": f"Bearer {openai_key}",
         }
         model = args.openai_model
     elif mode == LOCAL:
-        # Use a local server for accessing the language model
-        url = f'http://localhost:{args.port}/v1/chat/completions'
+        # Use the pool of local servers for accessing the language model
         headers = {}
         model = 'dummy'
     else:
         # Raise an exception if the mode is not recognized
         raise Exception(f'Unknown mode: `{mode}` for LLM inference')
-    
-    # Call a helper function to get the actual output from the LLM API
-    return get_llm_api_output(url, headers, model, system_prompt, prompt, args.temperature, args.max_tokens)
\ No newline at end of file
+
+    return headers, model
+
+
+def get_cached_output(system_prompt, prompt, args, attempt):
+    """
+    Look up a response in the shared LLM response cache.
+
+    Input:
+        system_prompt (str): The system prompt of the request.
+        prompt (str): The user prompt of the request.
+        args (Namespace): Arguments containing temperature and max_tokens.
+        attempt (int): Index of the attempt for this prompt.
+
+    Returns:
+        str: The cached response, None if it is not cached or caching is disabled.
+
+    Raises:
+        None
+    """
+    cache = get_cache()
+    if cache is None:
+        return None
+
+    output = cache.get(cache.make_key(args.temperature, args.max_tokens, system_prompt, prompt, attempt))
+    get_metrics().add(cache_hits=int(output is not None), cache_misses=int(output is None))
+    return output
+
+
+def cache_output(system_prompt, prompt, args, attempt, output):
+    """
+    Add a response to the shared LLM response cache, if caching is enabled.
+
+    Input:
+        system_prompt (str): The system prompt of the request.
+        prompt (str): The user prompt of the request.
+        args (Namespace): Arguments containing temperature and max_tokens.
+        attempt (int): Index of the attempt for this prompt.
+        output (str): The response of the LLM.
+
+    Returns:
+        None
+
+    Raises:
+        None
+    """
+    cache = get_cache()
+    if cache is not None:
+        cache.put(cache.make_key(args.temperature, args.max_tokens, system_prompt, prompt, attempt), output)
+
+
+def request_llm_output(system_prompt, prompt, mode, args, attempt=0, cancel=None, cache=True):
+    """
+    Request an output from the language model, bypassing the cache lookup.
+
+    Input:
+        system_prompt (str): The system prompt to guide the model's behavior.
+        prompt (str): The user prompt for which the model will generate a response.
+        mode (str): The mode of model usage, either 'OPENAI' for OpenAI's API or 'LOCAL' for a local model.
+        args (Namespace): An object containing necessary arguments, such as API keys, model settings, and other configurations.
+        attempt (int): Index of the attempt for this prompt, the output is cached under it.
+        cancel (threading.Event): Give up once it is set, outputs of cancelled requests are not cached.
+        cache (bool): Add the output to the cache, False if it is only cached once it is verified.
+
+    Returns:
+        tuple: The output text and a Counter with the token usage.
+
+    Raises:
+        CancelledError: If `cancel` was set before the request was sent.
+        Exception: If the 'mode' is neither 'OPENAI' nor 'LOCAL' or the request failed.
+    """
+    headers, model = get_request_config(mode, args)
+    outputs, usage = get_llm_api_output_with_retries(CHAT_COMPLETIONS_PATH, headers, model, system_prompt, prompt, args, cancel=cancel)
+    get_metrics().add_tokens(usage)
+
+    # A cancelled streamed output may be incomplete
+    if cache and (cancel is None or not cancel.is_set()):
+        cache_output(system_prompt, prompt, args, attempt, outputs[0])
+
+    return outputs[0], usage
+
+
+def get_llm_output(system_prompt, prompt, mode, args, attempt=0):
+    """
+    Generates the output from a language model based on given prompts and configuration.
+
+    Responses are looked up in (and added to) the shared LLM response cache, cached responses use no tokens.
+
+    Input:
+        system_prompt (str): The system prompt to guide the model's behavior.
+        prompt (str): The user prompt for which the model will generate a response.
+        mode (str): The mode of model usage, either 'OPENAI' for OpenAI's API or 'LOCAL' for a local model.
+        args (Namespace): An object containing necessary arguments, such as API keys, model settings, and other configurations.
+        attempt (int): Index of the attempt for this prompt, retries are cached separately.
+
+    Returns:
+        tuple: The output text and a Counter with the token usage.
+
+    Raises:
+        Exception: If the 'mode' is neither 'OPENAI' nor 'LOCAL'.
+    """
+    output = get_cached_output(system_prompt, prompt, args, attempt)
+    if output is not None:
+        return output, TOK_COUNT.copy()
+
+    return request_llm_output(system_prompt, prompt, mode, args, attempt)
+
+
+def get_llm_candidates(system_prompt, prompt, mode, args, attempts):
+    """
+    Generate several candidate outputs for the same prompt at once, yielding them as they become available.
+
+    Cached candidates are yielded first, in the order of their attempts. New candidates are not cached, the caller caches
+    the candidate that passes verification with `cache_output`, so that a rerun does not replay failed candidates. The OpenAI API generates the remaining
+    candidates in a single request with the `n` parameter; local servers, which often ignore `n`, get one request
+    per candidate in parallel and the candidates are yielded in the order they finish, so which fresh candidate is used
+    first depends on the response times. A failed candidate request is logged and skipped while other candidates can
+    still be yielded. Closing the generator cancels the candidates that are still pending.
+
+    Input:
+        system_prompt (str): The system prompt to guide the model's behavior.
+        prompt (str): The user prompt for which the model will generate a response.
+        mode (str): The mode of model usage, either 'OPENAI' for OpenAI's API or 'LOCAL' for a local model.
+        args (Namespace): An object containing necessary arguments, such as API keys, model settings, and other configurations.
+        attempts (list of int): Indices of the attempts, each candidate is cached under its own attempt.
+
+    Yields:
+        tuple: The output text of a candidate and a Counter with its token usage.
+
+    Raises:
+        Exception: If the 'mode' is neither 'OPENAI' nor 'LOCAL', or every pending candidate request failed.
+    """
+    pending = []
+    for attempt in attempts:
+        output = get_cached_output(system_prompt, prompt, args, attempt)
+        if output is not None:
+            yield output, TOK_COUNT.copy()
+        else:
+            pending.append(attempt)
+
+    if len(pending) == 1:
+        yield request_llm_output(system_prompt, prompt, mode, args, pending[0], cache=False)
+    elif pending and mode == OPENAI:
+        headers, model = get_request_config(mode, args)
+        outputs, usage = get_llm_api_output_with_retries(CHAT_COMPLETIONS_PATH, headers, model, system_prompt, prompt, args, n=len(pending))
+        get_metrics().add_tokens(usage)
+        # The usage of the request is attributed to its first candidate
+        for i, output in enumerate(outputs[:len(pending)]):
+            yield output, usage if i == 0 else TOK_COUNT.copy()
+    elif pending:
+        cancel = threading.Event()
+        stage = get_metrics().current_stage()
+
+        def request_candidate(attempt):
+            # Attribute the tokens to the stage of the caller, whose time already covers the request
+            with get_metrics().stage(stage, timed=False):
+                return request_llm_output(system_prompt, prompt, mode, args, attempt, cancel, cache=False)
+
+        executor = ThreadPoolExecutor(max_workers=len(pending))
+        futures = [executor.submit(request_candidate, attempt) for attempt in pending]
+        errors = []
+        try:
+            for future in as_completed(futures):
+                try:
+                    output = future.result()
+                except Exception as e:
+                    # The other candidates may still pass verification
+                    logging.warning(f'Candidate request failed: {e}')
+                    errors.append(e)
+                    continue
+                yield output
+        finally:
+            # Requests that are already in flight are abandoned, their outputs are discarded
+            cancel.set()
+            executor.shutdown(wait=False, cancel_futures=True)
+
+        if len(errors) == len(futures):
+            raise errors[0]
@@ -0,0 +1,432 @@
+from prompts import estimate_tokens
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import argparse
+import logging
+import random
+import math
+import json
+import time
+import ast
+import re
+
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s %(levelname)-8s %(message)s',
+    datefmt='%Y-%m-%d %H:%M:%S',
+)
+
+CODE_BLOCK_PATTERN = re.compile(r'### Original code block:\n```python\n(.*?)\n```\n', re.DOTALL)
+NUMBERED_CODE_BLOCK_PATTERN = re.compile(r'### Original code block \(with line numbers\):\n```python\n(.*?)\n```\n', re.DOTALL)
+NUMBERED_LINE_PATTERN = re.compile(r'^ *\d+ \| ', re.MULTILINE)
+FUNCTION_PATTERN = re.compile(r'^Function: (.*)$', re.MULTILINE)
+TRAILING_TEXT = '\nThis documentation was generated by the lmdocs simulator, which keeps on talking after the answer.'
+
+
+def get_args():
+    """
+    Parses and returns command line arguments for the simulator.
+
+    Input:
+        None
+
+    Returns:
+        argparse.Namespace: Namespace object containing parsed arguments.
+
+    Raises:
+        SystemExit: If the command line arguments are invalid.
+    """
+    parser = argparse.ArgumentParser(
+        description='Local OpenAI compatible LLM server that documents code without a model, for offline throughput testing of lmdocs'
+    )
+    parser.add_argument("-p", "--port", type=int, default=8080, help="Port to serve on (8080 by default)")
+    parser.add_argument("--model", default='lmdocs-simulator', help="Model name reported by /v1/models")
+    parser.add_argument(
+        "--latency_dist",
+        choices=['fixed', 'uniform', 'exponential', 'lognormal'],
+        default='fixed',
+        help="Distribution of the time to first token, with mean --latency (fixed by default)",
+    )
+    parser.add_argument("--latency", type=float, default=0.0, help="Mean time to first token in seconds (0 by default)")
+    parser.add_argument("--token_latency", type=float, default=0.0, help="Seconds to generate each completion token (0 by default)")
+    parser.add_argument("--trailing_tokens", type=int, default=0, help="Tokens generated after the closing code fence (0 by default)")
+    parser.add_argument("--error_rate", type=float, default=0.0, help="Fraction of requests that fail with HTTP 500 (0 by default)")
+    parser.add_argument("--rate_limit_rate", type=float, default=0.0, help="Fraction of requests rejected with HTTP 429 (0 by default)")
+    parser.add_argument("--retry_after", type=float, default=1.0, help="Retry-After seconds sent with HTTP 429 (1 by default)")
+    parser.add_argument("--seed", type=int, help="Seed for latencies and injected failures")
+    parser.add_argument("-v", "--verbose", action='store_true', help="Log every request")
+    return parser.parse_args()
+
+
+def sample_latency(args):
+    """
+    Sample the time to first token from the configured distribution.
+
+    Input:
+        args (Namespace): Arguments containing latency and latency_dist.
+
+    Returns:
+        float: Latency in seconds.
+
+    Raises:
+        None
+    """
+    if args.latency <= 0:
+        return 0.0
+    if args.latency_dist == 'uniform':
+        return random.uniform(0, 2 * args.latency)
+    if args.latency_dist == 'exponential':
+        return random.expovariate(1 / args.latency)
+    if args.latency_dist == 'lognormal':
+        # sigma = 1 with the mean kept at args.latency
+        return random.lognormvariate(math.log(args.latency) - 0.5, 1)
+    return args.latency
+
+
+def synthetic_docstring(node, indent):
+    """
+    Write a docstring for a function/class from its signature.
+
+    Input:
+        node (ast.AST): The function or class node.
+        indent (str): Indentation of the body of the node.
+
+    Returns:
+        list of str: Lines of the docstring.
+
+    Raises:
+        None
+    """
+    lines = [f'{indent}"""', f'{indent}Simulated documentation for `{node.name}`.', '']
+    if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)):
+        params = [arg.arg for arg in node.args.posonlyargs + node.args.args + node.args.kwonlyargs if arg.arg not in ('self', 'cls')]
+        lines += [f'{indent}Input:'] + [f'{indent}    {param}: The `{param}` argument.' for param in params or ['None']]
+        lines += ['', f'{indent}Returns:', f'{indent}    The result of `{node.name}`.', '', f'{indent}Raises:', f'{indent}    None']
+    lines.append(f'{indent}"""')
+    return lines
+
+
+def document_code(code):
+    """
+    Insert a synthetic docstring below the definition line(s) of a code block.
+
+    Input:
+        code (str): The code block from the prompt.
+
+    Returns:
+        str: The code block with a docstring, unchanged if it can not be parsed.
+
+    Raises:
+        None
+    """
+    try:
+        node = ast.parse(code).body[0]
+    except (SyntaxError, IndexError):
+        return code
+    if not isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)) or ast.get_docstring(node) is not None:
+        # Existing documentation is preserved
+        return code
+
+    first = node.body[0]
+    first_line = min([first.lineno] + [dec.lineno for dec in getattr(first, 'decorator_list', [])])
+    lines = code.split('\n')
+    if first_line == node.lineno:
+        # Single line definitions can not hold a docstring
+        return code
+
+    indent = re.match(r'\s*', lines[first_line - 1]).group(0)
+    return '\n'.join(lines[:first_line - 1] + synthetic_docstring(node, indent) + lines[first_line - 1:])
+
+
+def document_code_docstring_only(code):
+    """
+    Answer a docstring-only prompt: the contents of a synthetic docstring and a comment above the last line.
+
+    Input:
+        code (str): The code block from the prompt, without line numbers.
+
+    Returns:
+        str: The docstring contents, closed with triple quotes, followed by the comments.
+
+    Raises:
+        None
+    """
+    try:
+        node = ast.parse(code).body[0]
+    except (SyntaxError, IndexError):
+        return '"""'
+    if not isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+        return '"""'
+
+    doc = '\n'.join(synthetic_docstring(node, '')[1:-1])
+    if isinstance(node, ast.ClassDef):
+        return f'{doc}\n"""'
+    return f'{doc}\n"""\n### Comments\n{node.body[-1].lineno}: Simulated comment'
+
+
+def generate_completion(prompt):
+    """
+    Answer an lmdocs prompt without a model.
+
+    Input:
+        prompt (str): The user prompt.
+
+    Returns:
+        str: Documented code for generation prompts, a docstring for docstring-only prompts, JSON for batched summaries
+            and a single line for summaries.
+
+    Raises:
+        None
+    """
+    match = CODE_BLOCK_PATTERN.search(prompt)
+    if match:
+        return document_code(match.group(1)) + '\n```'
+
+    match = NUMBERED_CODE_BLOCK_PATTERN.search(prompt)
+    if match:
+        return document_code_docstring_only(NUMBERED_LINE_PATTERN.sub('', match.group(1)))
+
+    functions = FUNCTION_PATTERN.findall(prompt)
+    if prompt.rstrip().endswith('```json'):
+        return json.dumps({func: f'Simulated summary of `{func}`.' for func in functions}, indent=1) + '\n```'
+    if functions:
+        return f'Simulated summary of `{functions[0]}`.'
+    return 'Simulated response.'
+
+
+class SimulatorHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    args = None
+
+    def log_message(self, format, *log_args):
+        """
+        Log requests only in verbose mode.
+
+        Input:
+            format (str): Format string of the message.
+            *log_args: Arguments of the format string.
+
+        Returns:
+            None
+
+        Raises:
+            None
+        """
+        logging.debug(format % log_args)
+
+    def send_json(self, status, obj, headers=None):
+        """
+        Send a JSON response.
+
+        Input:
+            status (int): HTTP status code.
+            obj (object): JSON serializable body.
+            headers (dict): Additional headers.
+
+        Returns:
+            None
+
+        Raises:
+            None
+        """
+        body = json.dumps(obj).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        """
+        Serve /v1/models.
+
+        Input:
+            None
+
+        Returns:
+            None
+
+        Raises:
+            None
+        """
+        if self.path.rstrip('/') == '/v1/models':
+            self.send_json(200, {'object': 'list', 'data': [{'id': self.args.model, 'object': 'model', 'owned_by': 'lmdocs'}]})
+        else:
+            self.send_json(404, {'error': {'message': f'Unknown path: {self.path}'}})
+
+    def do_POST(self):
+        """
+        Serve /v1/chat/completions with injected latency, failures and optional streaming.
+
+        Input:
+            None
+
+        Returns:
+            None
+
+        Raises:
+            None
+        """
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if self.path.rstrip('/') != '/v1/chat/completions':
+            self.send_json(404, {'error': {'message': f'Unknown path: {self.path}'}})
+            return
+
+        try:
+            request = json.loads(body)
+            messages = request['messages']
+        except (ValueError, KeyError) as e:
+            self.send_json(400, {'error': {'message': f'Invalid request: {e}'}})
+            return
+
+        roll = random.random()
+        if roll < self.args.rate_limit_rate:
+            self.send_json(429, {'error': {'message': 'Simulated rate limit'}}, {'Retry-After': str(self.args.retry_after)})
+            return
+        if roll < self.args.rate_limit_rate + self.args.error_rate:
+            self.send_json(500, {'error': {'message': 'Simulated server error'}})
+            return
+
+        prompt = messages[-1]['content']
+        prompt_tokens = sum(estimate_tokens(message['content']) for message in messages)
+        max_tokens = request.get('max_tokens') or 2048
+        chunks = [(tokenize(generate_completion(prompt)) + self.trailing_tokens())[:max_tokens] for _ in range(request.get('n', 1))]
+        time.sleep(sample_latency(self.args))
+
+        if request.get('stream'):
+            self.stream_completion(chunks[0], prompt_tokens, request)
+            return
+
+        completion_tokens = sum(len(c) for c in chunks)
+        time.sleep(self.args.token_latency * max(len(c) for c in chunks))
+        self.send_json(200, {
+            'object': 'chat.completion',
+            'model': self.args.model,
+            'choices': [
+                {'index': i, 'message': {'role': 'assistant', 'content': ''.join(c)}, 'finish_reason': 'stop'}
+                for i, c in enumerate(chunks)
+            ],
+            'usage': {'prompt_tokens': prompt_tokens, 'completion_tokens': completion_tokens, 'total_tokens': prompt_tokens + completion_tokens},
+        })
+
+    def trailing_tokens(self):
+        """
+        Get the tokens the simulated model generates after its answer.
+
+        Input:
+            None
+
+        Returns:
+            list of str: `--trailing_tokens` pseudo tokens.
+
+        Raises:
+            None
+        """
+        if self.args.trailing_tokens <= 0:
+            return []
+        text_tokens = tokenize(TRAILING_TEXT)
+        return [text_tokens[i % len(text_tokens)] for i in range(self.args.trailing_tokens)]
+
+    def stream_completion(self, tokens, prompt_tokens, request):
+        """
+        Send a completion as server-sent events, one token per event.
+
+        Input:
+            tokens (list of str): Pseudo tokens of the completion.
+            prompt_tokens (int): Number of prompt tokens, reported in the final usage chunk.
+            request (dict): The chat completion request.
+
+        Returns:
+            None
+
+        Raises:
+            None
+        """
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        self.close_connection = True
+
+        sent = 0
+        try:
+            for token in tokens:
+                time.sleep(self.args.token_latency)
+                self.write_event({'object': 'chat.completion.chunk', 'choices': [{'index': 0, 'delta': {'content': token}}]})
+                sent += 1
+            if request.get('stream_options', {}).get('include_usage'):
+                self.write_event({'object': 'chat.completion.chunk', 'choices': [], 'usage': {
+                    'prompt_tokens': prompt_tokens, 'completion_tokens': sent, 'total_tokens': prompt_tokens + sent,
+                }})
+            self.wfile.write(b'data: [DONE]\n\n')
+        except (BrokenPipeError, ConnectionResetError):
+            logging.debug(f'Client closed the stream after {sent}/{len(tokens)} tokens')
+
+    def write_event(self, obj):
+        """
+        Write a single server-sent event.
+
+        Input:
+            obj (dict): JSON serializable event data.
+
+        Returns:
+            None
+
+        Raises:
+            BrokenPipeError: If the client closed the connection.
+        """
+        self.wfile.write(f'data: {json.dumps(obj)}\n\n'.encode('utf-8'))
+        self.wfile.flush()
+
+
+def tokenize(text):
+    """
+    Split a completion into pseudo tokens that join back into the original text.
+
+    Input:
+        text (str): The completion.
+
+    Returns:
+        list of str: Words and punctuation with their leading whitespace.
+
+    Raises:
+        None
+    """
+    return re.findall(r'\s*(?:\w+|[^\w\s])|\s+$', text)
+
+
+def main():
+    """
+    Run the simulator until interrupted.
+
+    Input:
+        None
+
+    Returns:
+        None
+
+    Raises:
+        None
+    """
+    args = get_args()
+    if args.verbose:
+        logging.getLogger().setLevel(logging.DEBUG)
+    if args.seed is not None:
+        random.seed(args.seed)
+
+    SimulatorHandler.args = args
+    server = ThreadingHTTPServer(('localhost', args.port), SimulatorHandler)
+    server.daemon_threads = True
+    logging.info(f'Simulating `{args.model}` on http://localhost:{args.port}/v1 (run lmdocs with -p {args.port})')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,10 @@
-from get_code_docs import CodeData, get_reference_docs_simple_functions, get_reference_docs_custom_functions, get_shortened_docs
-from constants import LOCAL, OPENAI
-from llm_inference import get_local_llm_name
+from get_code_docs import CodeData, get_reference_docs_simple_functions, get_reference_docs_custom_functions, get_shortened_docs, get_batched_summarized_docs
+from constants import LOCAL, OPENAI, SCAN, REFERENCE_LOOKUP, WRITE_BACK
+from llm_inference import get_client, init_client
+from llm_cache import init_cache
+from parse_cache import init_parse_cache
+from python_parsers import load_call_filter
+from metrics import init_metrics
 from utils import get_args, generate_report, get_code_dependancies_and_imports, generate_documentation_for_custom_calls, replace_modified_functions
 
 import logging
@@ -25,6 +29,7 @@ def main():
         Any exception raised during the execution will be logged, but none explicitly handled.
     """
     args = get_args()  # Get command-line arguments
+    metrics = init_metrics()  # Record the time and tokens of every stage
 
     if args.verbose:
         # Set logging level to DEBUG if verbose flag is set
@@ -32,43 +37,64 @@ def main():
 
     logging.info(f'Project path: {args.path}')  # Log the project path
 
+    # Share a pool of keep-alive connections across all LLM requests
+    init_client(args)
+
     # Determine the language model mode (local or OpenAI)
-    llm_mode = LOCAL if args.port else OPENAI
-    model_name = get_local_llm_name(args.port) if llm_mode == LOCAL else args.openai_model
+    llm_mode = LOCAL if args.port or args.endpoint else OPENAI
+    if llm_mode == LOCAL:
+        # Servers that do not respond are left out of the rotation until they recover
+        model_names = get_client().endpoints.health_check()
+        if len(set(model_names)) > 1:
+            logging.warning(f'LLM servers serve different models: {sorted(set(model_names))}')
+        model_name = model_names[0]
+    else:
+        model_name = args.openai_model
     logging.info(f'Using {llm_mode} LLM: {model_name}')  # Log the LLM being used
 
-    # Get code dependencies and import statements from the specified path
-    code_dependancies, import_stmts = get_code_dependancies_and_imports(args.path)
+    # Reuse responses to identical prompts from previous runs
+    init_cache(args, model_name)
+
+    # Get code dependencies and import statements from the specified path, reusing the files parsed by previous runs
+    call_filter = load_call_filter(args.ignore_file, args.ignore_builtins)
+    init_parse_cache(args, call_filter.fingerprint)
+    with metrics.stage(SCAN):
+        code_dependancies, import_stmts = get_code_dependancies_and_imports(args.path, args.scan_jobs, call_filter, args.low_memory)
     logging.debug(f'Found {len(code_dependancies.keys())} functions/methods/clases: ')
 
     # Identify simple functions with no dependencies
     simple_funcs = [func_name for func_name in code_dependancies.keys() if code_dependancies.dependancies(func_name) == 0]
-    reference_docs = get_reference_docs_simple_functions(import_stmts, simple_funcs)
+    with metrics.stage(REFERENCE_LOOKUP):
+        reference_docs = get_reference_docs_simple_functions(import_stmts, simple_funcs)
     logging.info(f'Reference documentation found for {len([x for x in reference_docs if x != "-"])}/{len(code_dependancies.keys())} calls')
 
-    num_simple_funcs = len(simple_funcs)  # Number of simple functions
     logging.info(f'Using `{args.ref_doc}` strategy to shorten docs')
 
-    # Process each simple function and add shortened documentation
-    for i, (func, known_doc) in enumerate(zip(simple_funcs, reference_docs)):
-        if args.ref_doc == 'summarize' and (num_simple_funcs <= 10 or (i + 1) % (round(num_simple_funcs / 10)) == 0):
-            logging.info(f'\t[{i+1}/{num_simple_funcs}] {round(100*(i+1)/num_simple_funcs)}% done')
+    if args.ref_doc == 'summarize':
+        # Summarize several docs per LLM request
+        short_docs = get_batched_summarized_docs(simple_funcs, reference_docs, llm_mode, args)
+    else:
+        short_docs = [get_shortened_docs(func, known_doc, args.ref_doc, llm_mode, args) for func, known_doc in zip(simple_funcs, reference_docs)]
 
-        code_dependancies.add(
-            func,
-            {CodeData.DOC_SHORT: get_shortened_docs(func, known_doc, args.ref_doc, llm_mode, args)}
-        )
+    # Add the shortened documentation of each simple function
+    for func, short_doc in zip(simple_funcs, short_docs):
+        code_dependancies.add(func, {CodeData.DOC_SHORT: short_doc})
 
     # Generate documentation for custom calls
     generate_documentation_for_custom_calls(code_dependancies, llm_mode, args)
 
-    # Replace the modified functions in the original code
-    replace_modified_functions(code_dependancies, args.path)
-
-    # Generate a report and save it as a CSV file
+    # Generate a report and save it as a CSV file, before the original code is modified (it is read from the files with --low_memory)
     generate_report(code_dependancies, f'doc_report_{args.path.split("/")[-1]}.csv')
     logging.info(f'Saved Documentation report in ./doc_report_{args.path.split("/")[-1]}.csv')
 
+    # Replace the modified functions in the original code
+    with metrics.stage(WRITE_BACK):
+        replace_modified_functions(code_dependancies, args.path)
+
+    logging.info(f'Time per stage: {metrics.summary()}')
+    if args.metrics_path:
+        metrics.export(args.metrics_path, args.metrics_format)
+
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -0,0 +1,307 @@
+from constants import STAGES, TOK_COUNT
+from contextlib import contextmanager
+from collections import Counter
+import threading
+import logging
+import json
+import time
+
+
+class Metrics:
+    def __init__(self):
+        """
+        Initializes the metrics of a run: time, tokens, LLM requests and cache usage per pipeline stage and the result of every function.
+
+        Input:
+            None
+
+        Returns:
+            None
+
+        Raises:
+            None
+        """
+        self.start = time.monotonic()
+        self.stages = {stage: Counter({'seconds': 0.0, 'calls': 0}) for stage in STAGES}
+        self.functions = {}
+        self.lock = threading.Lock()  # Metrics are recorded from multiple worker threads
+        self.local = threading.local()  # Stack of the stages entered by each thread
+
+    def _stack(self):
+        """
+        Get the stack of stages entered by the current thread.
+
+        Input:
+            None
+
+        Returns:
+            list of list: [stage, start time, time spent in nested stages] for each entered stage.
+
+        Raises:
+            None
+        """
+        if not hasattr(self.local, 'stack'):
+            self.local.stack = []
+        return self.local.stack
+
+    def current_stage(self):
+        """
+        Get the innermost stage entered by the current thread.
+
+        Input:
+            None
+
+        Returns:
+            str: Name of the stage, None outside of any stage.
+
+        Raises:
+            None
+        """
+        stack = self._stack()
+        return stack[-1][0] if stack else None
+
+    @contextmanager
+    def stage(self, name, timed=True):
+        """
+        Record the time spent in a pipeline stage.
+
+        Stages can be nested, time spent in a nested stage only counts towards the nested stage.
+        Stages running on several threads add up the time of every thread.
+
+        Input:
+            name (str): Name of the stage.
+            timed (bool): False to only attribute counters (e.g. tokens) of a helper thread to the stage, without its time.
+
+        Returns:
+            None
+
+        Raises:
+            None
+        """
+        stack = self._stack()
+        frame = [name, time.monotonic(), 0.0]
+        stack.append(frame)
+        try:
+            yield
+        finally:
+            stack.pop()
+            elapsed = time.monotonic() - frame[1]
+            if timed:
+                if stack:
+                    stack[-1][2] += elapsed
+                self.add(name, seconds=elapsed - frame[2], calls=1)
+
+    def add(self, stage=None, **counts):
+        """
+        Add to the counters of a stage.
+
+        Input:
+            stage (str): Name of the stage, the current stage of the thread by default.
+            **counts: Amounts to add to each counter, e.g. `api_retries=1`.
+
+        Returns:
+            None
+
+        Raises:
+            None
+        """
+        stage = stage or self.current_stage() or 'other'
+        with self.lock:
+            self.stages.setdefault(stage, Counter({'seconds': 0.0, 'calls': 0})).update(counts)
+
+    def add_tokens(self, usage, stage=None):
+        """
+        Add the token usage of an LLM request to a stage.
+
+        Input:
+            usage (Counter): Token usage of the request.
+            stage (str): Name of the stage, the current stage of the thread by default.
+
+        Returns:
+            None
+
+        Raises:
+            None
+        """
+        self.add(stage, llm_requests=1, **{k: usage[k] for k in TOK_COUNT})
+
+    def record_function(self, name, path, seconds, tokens, tries, reason, reused):
+        """
+        Record the result of documenting a function/method/class.
+
+        Input:
+            name (str): Name of the function/method/class.
+            path (str): Path of the file containing it.
+            seconds (float): Time spent documenting it.
+            tokens (Counter): Tokens used across all tries.
+            tries (int): Number of LLM outputs that were checked.
+            reason (str): Reason of the last failure, None if there was none.
+            reused (bool): True if the documentation was reused from the incremental manifest.
+
+        Returns:
+            None
+
+        Raises:
+            None
+        """
+        with self.lock:
+            self.functions[name] = {
+                'path': path,
+                'seconds': round(seconds, 3),
+                **{k: tokens[k] for k in TOK_COUNT},
+                'tries': tries,
+                'reused': reused,
+                'failure_reason': reason,
+            }
+
+    def to_dict(self):
+        """
+        Get all metrics as a JSON serializable dict.
+
+        Input:
+            None
+
+        Returns:
+            dict: Wall time of the run, counters of every stage and the result of every function.
+
+        Raises:
+            None
+        """
+        with self.lock:
+            return {
+                'wall_seconds': round(time.monotonic() - self.start, 3),
+                'stages': {stage: {k: round(v, 3) if isinstance(v, float) else v for k, v in counts.items()} for stage, counts in self.stages.items()},
+                'functions': {name: dict(func) for name, func in self.functions.items()},
+            }
+
+    def to_prometheus(self):
+        """
+        Get all metrics in the Prometheus text exposition format, e.g. for the textfile collector of the node exporter.
+
+        Input:
+            None
+
+        Returns:
+            str: The metrics, one sample per line.
+
+        Raises:
+            None
+        """
+        data = self.to_dict()
+        lines = [
+            '# HELP lmdocs_wall_seconds Wall time of the run',
+            '# TYPE lmdocs_wall_seconds gauge',
+            f'lmdocs_wall_seconds {data["wall_seconds"]}',
+        ]
+
+        counters = sorted(set(k for counts in data['stages'].values() for k in counts))
+        for counter in counters:
+            lines += [f'# HELP lmdocs_stage_{counter} {counter} per pipeline stage', f'# TYPE lmdocs_stage_{counter} gauge']
+            lines += [
+                f'lmdocs_stage_{counter}{{stage="{escape_label(stage)}"}} {counts[counter]}'
+                for stage, counts in data['stages'].items() if counter in counts
+            ]
+
+        for field in ['seconds', *TOK_COUNT, 'tries']:
+            lines += [f'# HELP lmdocs_function_{field} {field} per function/method/class', f'# TYPE lmdocs_function_{field} gauge']
+            lines += [
+                f'lmdocs_function_{field}{{function="{escape_label(name)}",path="{escape_label(func["path"])}"}} {func[field]}'
+                for name, func in data['functions'].items()
+            ]
+
+        lines += ['# HELP lmdocs_function_success 1 if the documentation was generated', '# TYPE lmdocs_function_success gauge']
+        lines += [
+            f'lmdocs_function_success{{function="{escape_label(name)}",path="{escape_label(func["path"])}"}} {int(func["failure_reason"] is None)}'
+            for name, func in data['functions'].items()
+        ]
+        return '\n'.join(lines) + '\n'
+
+    def export(self, path, fmt='json'):
+        """
+        Write all metrics to a file.
+
+        Input:
+            path (str): Path of the file.
+            fmt (str): 'json' or 'prometheus'.
+
+        Returns:
+            None
+
+        Raises:
+            OSError: If the file can not be written.
+        """
+        with open(path, 'w') as f:
+            if fmt == 'prometheus':
+                f.write(self.to_prometheus())
+            else:
+                json.dump(self.to_dict(), f, indent=1)
+        logging.info(f'Saved {fmt} metrics in {path}')
+
+    def summary(self):
+        """
+        Get a printable summary of the time spent in each stage.
+
+        Input:
+            None
+
+        Returns:
+            str: Seconds spent in each stage that was entered.
+
+        Raises:
+            None
+        """
+        with self.lock:
+            return ', '.join(f'{stage}: {counts["seconds"]:.1f}s' for stage, counts in self.stages.items() if counts['calls'])
+
+
+def escape_label(value):
+    """
+    Escape a Prometheus label value.
+
+    Input:
+        value (str): The label value.
+
+    Returns:
+        str: The value with backslashes, double quotes and newlines escaped.
+
+    Raises:
+        None
+    """
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+METRICS = Metrics()
+
+
+def init_metrics():
+    """
+    Reset the shared metrics at the start of a run.
+
+    Input:
+        None
+
+    Returns:
+        Metrics: The shared metrics.
+
+    Raises:
+        None
+    """
+    global METRICS
+    METRICS = Metrics()
+    return METRICS
+
+
+def get_metrics():
+    """
+    Get the shared metrics.
+
+    Input:
+        None
+
+    Returns:
+        Metrics: The shared metrics.
+
+    Raises:
+        None
+    """
+    return METRICS
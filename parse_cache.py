@@ -0,0 +1,211 @@
+from constants import PARSE_CACHE_VERSION
+import threading
+import hashlib
+import logging
+import sqlite3
+import json
+import os
+
+
+class ParseCache:
+    def __init__(self, path, settings=''):
+        """
+        Initializes a persistent cache of the imports, functions, classes and methods extracted from each Python file,
+        stored in an SQLite database.
+
+        Input:
+            path (str): Path of the SQLite database, created if it does not exist.
+            settings (str): Identifies the settings of the extraction (e.g. the ignored calls), files cached with other
+                            settings are parsed again.
+
+        Returns:
+            None
+
+        Raises:
+            sqlite3.Error: If the database can not be opened.
+        """
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        self.path = path
+        self.version = f'{PARSE_CACHE_VERSION}:{settings}'
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, version TEXT, size INTEGER, mtime_ns INTEGER, hash TEXT, data TEXT)')
+        self.conn.commit()
+
+    def get(self, fpath):
+        """
+        Look up the extracted content of a file.
+
+        The file is only read and hashed if its size or modification time changed since it was cached,
+        a file that was touched but not modified is still a hit.
+
+        Input:
+            fpath (str): Path of the Python file.
+
+        Returns:
+            tuple:
+                - result (tuple): The import statements, aliases and blobs of the file as returned by `extract_file`, None on a miss.
+                - stat (os.stat_result): Status of the file before it was looked up, to pass to `put` on a miss.
+
+        Raises:
+            OSError: If the file can not be read.
+        """
+        key = os.path.abspath(fpath)
+        stat = os.stat(fpath)
+        with self.lock:
+            row = self.conn.execute('SELECT version, size, mtime_ns, hash, data FROM files WHERE path = ?', (key,)).fetchone()
+
+        if row is None or row[0] != self.version:
+            self.misses += 1
+            return None, stat
+
+        _, size, mtime_ns, digest, data = row
+        if (size, mtime_ns) != (stat.st_size, stat.st_mtime_ns):
+            with open(fpath, 'rb') as f:
+                if hash_code(f.read().decode('utf-8')) != digest:
+                    self.misses += 1
+                    return None, stat
+            with self.lock:
+                self.conn.execute('UPDATE files SET size = ?, mtime_ns = ? WHERE path = ?', (stat.st_size, stat.st_mtime_ns, key))
+                self.conn.commit()
+
+        self.hits += 1
+        import_stmts, aliases, blobs = json.loads(data)
+        return (import_stmts, aliases, [tuple(blob) for blob in blobs]), stat
+
+    def put(self, fpath, stat, digest, result):
+        """
+        Store the extracted content of a file.
+
+        Input:
+            fpath (str): Path of the Python file.
+            stat (os.stat_result): Status of the file before it was read, as returned by `get`.
+            digest (str): Hash of the code that was parsed, see `hash_code`.
+            result (tuple): The import statements, aliases and blobs of the file as returned by `extract_file`.
+
+        Returns:
+            None
+
+        Raises:
+            None
+        """
+        with self.lock:
+            self.conn.execute(
+                'INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?)',
+                (os.path.abspath(fpath), self.version, stat.st_size, stat.st_mtime_ns, digest, json.dumps(result))
+            )
+
+    def commit(self):
+        """
+        Write the stored files to the database, once per scan rather than once per file.
+
+        Input:
+            None
+
+        Returns:
+            None
+
+        Raises:
+            None
+        """
+        with self.lock:
+            self.conn.commit()
+
+    def stats(self):
+        """
+        Get a printable summary of the cache usage.
+
+        Input:
+            None
+
+        Returns:
+            str: Number of cache hits and misses.
+
+        Raises:
+            None
+        """
+        return f'parse_cache_hits: {self.hits}, parse_cache_misses: {self.misses}'
+
+    def close(self):
+        """
+        Close the underlying database.
+
+        Input:
+            None
+
+        Returns:
+            None
+
+        Raises:
+            None
+        """
+        with self.lock:
+            self.conn.close()
+
+
+def hash_code(code_str):
+    """
+    Hash the content of a Python file.
+
+    Input:
+        code_str (str): The code of the file.
+
+    Returns:
+        str: SHA-256 hex digest of the code.
+
+    Raises:
+        None
+    """
+    return hashlib.sha256(code_str.encode('utf-8')).hexdigest()
+
+
+PARSE_CACHE = None
+
+
+def init_parse_cache(args, settings=''):
+    """
+    Open the shared parse cache unless it is disabled with --no_parse_cache.
+
+    Input:
+        args (Namespace): Arguments containing no_parse_cache and parse_cache_path.
+        settings (str): Identifies the settings of the extraction, see `ParseCache`.
+
+    Returns:
+        ParseCache: The shared cache, None if caching is disabled.
+
+    Raises:
+        None
+    """
+    global PARSE_CACHE
+    if PARSE_CACHE is not None:
+        PARSE_CACHE.close()
+        PARSE_CACHE = None
+
+    if args.no_parse_cache:
+        logging.info('Parse cache disabled')
+        return None
+
+    PARSE_CACHE = ParseCache(args.parse_cache_path, settings)
+    logging.info(f'Using parse cache: {args.parse_cache_path}')
+    return PARSE_CACHE
+
+
+def get_parse_cache():
+    """
+    Get the shared parse cache.
+
+    Input:
+        None
+
+    Returns:
+        ParseCache: The shared cache, None if `init_parse_cache` was not called or caching is disabled.
+
+    Raises:
+        None
+    """
+    return PARSE_CACHE
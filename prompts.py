@@ -1,3 +1,25 @@
+import re
+
+
+TOKEN_PATTERN = re.compile(r'\w+|[^\w\s]')
+
+
+def estimate_tokens(text):
+    """
+    Quickly estimate the number of tokens in a text without a tokenizer.
+
+    Input:
+    text (str): The text to estimate
+
+    Returns:
+    int: Number of words and punctuation characters, which is close to the number of BPE tokens for code and English text
+
+    Raises:
+    None
+    """
+    return len(TOKEN_PATTERN.findall(text))
+
+
 def format_docs(ref_docs):
     """
     Formats a list of reference documentation into a structured string.
@@ -54,6 +76,57 @@ DOC_GENERATION_PROMPT = lambda func, ref_docs: f'''\
 '''
 
 
+DOC_ONLY_INSTRUCTIONS = '''\
+- Generate documentation for the python function/class given below, without repeating its code.
+- Reply with a docstring that contains:
+    - A single line summary
+    - Input: Short descriptions of each input parameter
+    - Returns: Short descriptions of each output parameter
+    - Raises: Short description of failure cases and exceptions raised by the class, method, or function
+- Optionally, add short inline comments for blocks of code that are hard to understand:
+    - List them after the docstring under "### Comments", one per line as `<line number>: <comment>`
+    - The line number is the number of the line in the original code block that the comment is placed above
+    - Only write such comments for blocks of code, not for every line, and never for a class
+- You also have access to reference documentation for sub-functions and sub-classes used in the original class, method, or function. These should be used for enhanced context for better documentation.
+- Preserve the content of any existing docstring of the original class, method, or function in the new docstring.
+- Only reply with the contents of the docstring, closed with triple double quotes, and the optional comments, followed by the stop token: <STOP>'''
+
+
+def number_lines(func):
+    """
+    Prefix every line of a code block with its (1-based) line number.
+
+    Input:
+    func (str): The code block
+
+    Returns:
+    str: The numbered code block
+
+    Raises:
+    None
+    """
+    lines = func.split('\n')
+    width = len(str(len(lines)))
+    return '\n'.join(f'{str(i).rjust(width)} | {line}' for i, line in enumerate(lines, start=1))
+
+
+DOC_ONLY_GENERATION_PROMPT = lambda func, ref_docs: f'''\
+### Guidelines:
+{DOC_ONLY_INSTRUCTIONS}
+
+### Reference documentation:
+{format_docs(ref_docs)}
+
+### Original code block (with line numbers):
+```python
+{number_lines(func)}
+```
+
+### Docstring:
+"""
+'''
+
+
 DOC_SUMMARIZATION_PROMPT = lambda func, doc: f'''\
 ### Guidelines
 Summarize the given function documentation in a single line.
@@ -65,4 +138,82 @@ Function: {func}
 {doc}
 
 ### Summarized documentation
-'''
\ No newline at end of file
+'''
+
+
+DOC_BATCH_SUMMARIZATION_PROMPT = lambda ref_docs: f'''\
+### Guidelines
+Summarize the documentation of each function given below in a single line.
+Make sure that the key nuances and overall meaning of each documentation are captured in its summary
+Only reply with a JSON object that maps every function name to its summarized documentation, followed by the stop token <STOP>
+
+### Original documentation
+{format_docs(ref_docs)}
+
+### Summarized documentation
+```json
+'''
+
+
+
+def count_calls(func, name):
+    """
+    Count how often a function is called in a code block.
+
+    Input:
+    func (str): The code block
+    name (str): The (possibly dotted) name of the called function, only the last part is matched
+
+    Returns:
+    int: Number of calls of the function
+
+    Raises:
+    None
+    """
+    return len(re.findall(rf'\b{re.escape(name.split(".")[-1])}\s*\(', func))
+
+
+def build_doc_generation_prompt(func, ref_docs, max_prompt_tokens=None, template=DOC_GENERATION_PROMPT):
+    """
+    Build the documentation prompt for a code block, fitting the reference documentation into a token budget.
+
+    Reference docs are ranked by how often they are called in the code block. In order of rank, each doc is kept
+    if it fits, shortened to its first line if only that fits, and dropped otherwise.
+
+    Input:
+    func (str): The code block to document
+    ref_docs (list of dict): List of dictionaries, each containing 'function' and 'doc_str' keys
+    max_prompt_tokens (int): Maximum (estimated) number of tokens of the prompt, None for no limit
+    template (function): Prompt template, DOC_GENERATION_PROMPT or DOC_ONLY_GENERATION_PROMPT
+
+    Returns:
+    tuple:
+        - prompt (str): The documentation prompt
+        - ref_docs (list of dict): The reference docs used in the prompt, in their original order
+        - tokens_saved (int): Estimated number of tokens removed from the reference docs
+
+    Raises:
+    None
+    """
+    prompt = template(func, ref_docs)
+    if max_prompt_tokens is None or estimate_tokens(prompt) <= max_prompt_tokens:
+        return prompt, ref_docs, 0
+
+    budget = max_prompt_tokens - estimate_tokens(template(func, []))
+    ranks = sorted(range(len(ref_docs)), key=lambda i: -count_calls(func, ref_docs[i]['function']))
+
+    kept = {}
+    for i in ranks:
+        ref_doc = ref_docs[i]
+        short_doc = {'function': ref_doc['function'], 'doc_str': ref_doc['doc_str'].strip().split('\n')[0]}
+        for candidate in [ref_doc, short_doc]:
+            # Two newlines separate consecutive docs
+            num_tokens = estimate_tokens(format_docs([candidate])) + 2
+            if num_tokens <= budget:
+                kept[i] = candidate
+                budget -= num_tokens
+                break
+
+    fitted_docs = [kept[i] for i in sorted(kept)]
+    fitted_prompt = template(func, fitted_docs)
+    return fitted_prompt, fitted_docs, estimate_tokens(prompt) - estimate_tokens(fitted_prompt)
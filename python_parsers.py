@@ -4,33 +4,81 @@ from constants import CALLS_TO_INGORE
 import re
 from itertools import zip_longest
 from typing import Union
-from get_code_docs import CodeData
+from get_code_docs import CodeData, read_segment
 import logging
-import tokenize
+import inspect
 import copy
 import subprocess
+import builtins
+import os
+import hashlib
 import sys
 
 
-def to_remove(call_str):
+class CallFilter:
+    def __init__(self, names):
+        """
+        Initializes a filter of the calls that are not documented, compiled once from a list of ignored names.
+
+        A call is ignored if it is one of the names (case insensitive), or a method call on a name, e.g. `x.append`.
+
+        Input:
+            names (iterable of str): The ignored function/method names.
+
+        Returns:
+            None
+
+        Raises:
+            None
+        """
+        self.names = frozenset(name.lower().strip() for name in names if name.strip())
+        # One alternation of every name, longest first, instead of one pattern per name
+        suffixes = sorted({name.strip() for name in names if name.strip()}, key=lambda name: (-len(name), name))
+        self.method_pattern = re.compile(r'[^\W0-9]\w*\.(?:' + '|'.join(map(re.escape, suffixes)) + ')') if suffixes else None
+        self.fingerprint = hashlib.sha256('\n'.join(suffixes).encode('utf-8')).hexdigest()
+
+    def __call__(self, call_str):
+        """
+        Determines if a given call string should be removed.
+
+        Input:
+            call_str (str): The call string to be checked.
+
+        Returns:
+            bool: True if the call string matches an ignored name, False otherwise.
+
+        Raises:
+            None
+        """
+        return call_str.lower().strip() in self.names or (self.method_pattern is not None and self.method_pattern.fullmatch(call_str) is not None)
+
+
+def load_call_filter(ignore_file=None, ignore_builtins=False):
     """
-    Determines if a given call string should be removed based on specific criteria.
+    Build the filter of ignored calls from the default ignore list and the user configuration.
 
     Input:
-        call_str (str): The call string to be checked.
+        ignore_file (str): Path of a file with one more ignored name per line, blank lines and `#` comments are skipped.
+        ignore_builtins (bool): True to also ignore all builtins and the methods of `str`, `list` and `dict`.
 
     Returns:
-        bool: True if the call string matches any criteria for removal, False otherwise.
+        CallFilter: The compiled filter.
 
     Raises:
-        None
-
+        OSError: If the ignore file can not be read.
     """
-    for call in CALLS_TO_INGORE:
-        # Check if call string matches any ignored call strings (case insensitive)
-        if call.lower().strip() == call_str.lower().strip() or re.fullmatch(f'[^\W0-9]\w*.{call}', call_str):
-            return True
-    return False
+    names = set(CALLS_TO_INGORE)
+    if ignore_file:
+        with open(ignore_file) as f:
+            names.update(line.split('#', 1)[0].strip() for line in f)
+    if ignore_builtins:
+        for obj in (builtins, str, list, dict):
+            names.update(name for name in dir(obj) if not name.startswith('_'))
+    names.discard('')
+    return CallFilter(names)
+
+
+DEFAULT_CALL_FILTER = CallFilter(CALLS_TO_INGORE)
 
 
 class FuncCallVisitor(ast.NodeVisitor):
@@ -96,95 +144,365 @@ class FuncCallVisitor(ast.NodeVisitor):
             self.generic_visit(node)
            
  
-def get_func_calls(tree):
-    """
-    Extract and return a list of unique function call names from an abstract syntax tree (AST).
+class FileExtractor(ast.NodeVisitor):
+    def __init__(self, path, code_str, call_filter=DEFAULT_CALL_FILTER):
+        """
+        Initializes a single pass extractor of the imports, functions, classes and methods of a Python file.
 
-    Input:
-    tree: The root node of the AST to traverse.
+        Input:
+            path (str): The file path from which the code string was read.
+            code_str (str): The Python code of the file, with its original line endings.
+            call_filter (CallFilter): Filter of the calls that are left out of the dependencies.
 
-    Returns:
-    A list of unique function names called within the AST.
+        Returns:
+            None
 
-    Raises:
-    No specific exceptions are raised, but the function assumes that `tree` is a valid AST node.
-    """
-    func_calls = []
-    for node in ast.walk(tree):  # Iterate through all nodes in the AST
-        if isinstance(node, ast.Call):  # Check if the node is a function call
+        Raises:
+            None
+        """
+        self.path = path
+        self.call_filter = call_filter
+        # Source segments are cut from the encoded lines, AST column offsets are in bytes
+        self.lines = code_str.encode('utf-8').splitlines(keepends=True)
+        self.offsets = [0]  # Byte offset of the start of every line in the file
+        for line in self.lines:
+            self.offsets.append(self.offsets[-1] + len(line))
+        self.import_stmts = []
+        self.aliases = {}  # Imported name -> [relative import level, imported dotted name], '*' -> [level, module] of star imports
+        self.blobs = []  # (name, data) of every function, class and method, methods before their class
+        self.defs = []  # Stack of the function/class nodes being visited
+        self.calls = []  # Call lists of the functions/classes/methods being visited
+        self.children = set()  # Ids of the direct children of the module/class being visited, whose definitions are recorded
+
+    def segment(self, node):
+        """
+        Get the source code of a node, like `ast.get_source_segment` but without splitting the file for every node.
+
+        Input:
+            node (ast.AST): The node, with position information.
+
+        Returns:
+            str: The source code of the node, with `\n` line endings.
+
+        Raises:
+            None
+        """
+        start, end = self.span(node)
+        return read_segment(b''.join(self.lines[node.lineno - 1:node.end_lineno]), start - self.offsets[node.lineno - 1], end - self.offsets[node.lineno - 1])
+
+    def span(self, node):
+        """
+        Get the position of a node in the file.
+
+        Input:
+            node (ast.AST): The node, with position information.
+
+        Returns:
+            list: The start and end byte offsets of the node in the file.
+
+        Raises:
+            None
+        """
+        return [self.offsets[node.lineno - 1] + node.col_offset, self.offsets[node.end_lineno - 1] + node.end_col_offset]
+
+    def visit_Import(self, node):
+        """
+        Record an import statement and the names it binds.
+
+        Input:
+            node (ast.Import): The import node.
+
+        Returns:
+            None
+
+        Raises:
+            None
+        """
+        self.import_stmts.append(self.segment(node))
+        for alias in node.names:
+            if alias.asname:
+                self.aliases[alias.asname] = [0, alias.name]
+            else:
+                # `import a.b` binds `a`
+                head = alias.name.split('.')[0]
+                self.aliases[head] = [0, head]
+
+    def visit_ImportFrom(self, node):
+        """
+        Record a `from ... import ...` statement and the names it binds.
+
+        Input:
+            node (ast.ImportFrom): The import node.
+
+        Returns:
+            None
+
+        Raises:
+            None
+        """
+        self.import_stmts.append(self.segment(node))
+        for alias in node.names:
+            if alias.name == '*':
+                self.aliases.setdefault('*', []).append([node.level, node.module or ''])
+            else:
+                self.aliases[alias.asname or alias.name] = [node.level, f'{node.module}.{alias.name}' if node.module else alias.name]
+
+    def visit_Call(self, node):
+        """
+        Record a call for every function/class/method it is part of.
+
+        Input:
+            node (ast.Call): The call node.
+
+        Returns:
+            None
+
+        Raises:
+            None
+        """
+        if self.calls:
             callvisitor = FuncCallVisitor()
             callvisitor.visit(node.func)
-            func_calls.append((callvisitor.name))
+            for calls in self.calls:
+                calls.append(callvisitor.name)
+        self.generic_visit(node)
+
+    def visit_FunctionDef(self, node):
+        """
+        Visit a function/class definition, recording top level functions/classes and the methods of top level classes.
+
+        Input:
+            node (ast.FunctionDef or ast.ClassDef): The definition node.
+
+        Returns:
+            None
 
-    func_calls = list(set(func_calls))  # Remove duplicate function names
-    func_calls = [func for func in func_calls if not to_remove(func)]  # Filter out functions that need to be removed
+        Raises:
+            None
+        """
+        is_method = len(self.defs) == 1 and isinstance(self.defs[0], ast.ClassDef) and isinstance(node, ast.FunctionDef) and id(node) in self.children
+        if (self.defs and not is_method) or (not self.defs and id(node) not in self.children):
+            # Nested and conditional definitions are part of the function/class/method (or module) they are defined in
+            self.defs.append(node)
+            self.generic_visit(node)
+            self.defs.pop()
+            return
+
+        calls = []
+        self.defs.append(node)
+        self.calls.append(calls)
+        children, self.children = self.children, {id(child) for child in node.body}
+        self.generic_visit(node)
+        self.children = children
+        self.calls.pop()
+        self.defs.pop()
+
+        calls = [call for call in dict.fromkeys(calls) if not self.call_filter(call)]  # Unique calls, in a stable order
+        data = {
+            CodeData.CODE: self.segment(node),
+            CodeData.SPAN: self.span(node),
+            CodeData.DEP: calls,
+            CodeData.CUSTOM: True,
+            CodeData.PATH: self.path,
+        }
+        if is_method:
+            # Indentation of the definition line, which is not part of the source segment
+            data[CodeData.CODE_INDENT] = self.lines[node.lineno - 1][:node.col_offset].decode('utf-8')
+            data[CodeData.TYPE] = 'method'
+        elif isinstance(node, ast.ClassDef):
+            # Classes are documented after their methods, whose docstrings are part of the class prompt
+            data[CodeData.DEP] = calls + [f'{node.name}.{child.name}' for child in node.body if isinstance(child, ast.FunctionDef)]
+            data[CodeData.TYPE] = 'class'
+        else:
+            data[CodeData.TYPE] = 'function'
+        # Name qualified within the module, e.g. `Class.method`
+        self.blobs.append(('.'.join(owner.name for owner in self.defs + [node]), data))
 
-    return func_calls
+    visit_ClassDef = visit_FunctionDef
 
 
-def get_all_calls(path, code_str, funcs):
+def extract_file(path, code_str, call_filter=DEFAULT_CALL_FILTER):
     """
-    Extracts all function and method calls from the given Python code string and adds them to a provided data structure.
+    Extract the import statements and all functions, classes and methods of a Python file in a single pass.
 
     Input:
         path (str): The file path from which the code string was read.
         code_str (str): The string containing Python code to be parsed.
-        funcs (object): A data structure (e.g., dictionary or custom object) to store information about the functions and methods extracted.
+        call_filter (CallFilter): Filter of the calls that are left out of the dependencies.
 
     Returns:
-        None: This function updates the `funcs` data structure in place.
+        tuple:
+            - import_stmts (list of str): The import statements of the file, at any level.
+            - aliases (dict): The names bound by the imports, see `SymbolTable.add_module`.
+            - blobs (list of tuple): (name, data) of the top level functions/classes and the methods of top level classes,
+              named within the module (e.g. `Class.method`) and with unresolved calls as dependencies.
+              Data only holds JSON serializable values, nodes are parsed from the code when needed, see `CodeData.node`.
 
     Raises:
         SyntaxError: If the provided `code_str` is not valid Python code.
     """
-    
-    tree = ast.parse(code_str)  # Parse the source code into an AST node
+    extractor = FileExtractor(path, code_str, call_filter)
+    tree = ast.parse(code_str)
+    extractor.children = {id(node) for node in tree.body}
+    extractor.visit(tree)
+    return extractor.import_stmts, extractor.aliases, extractor.blobs
+
+
+def get_module_name(root, fpath):
+    """
+    Get the dotted name of the module defined by a Python file.
+
+    Input:
+        root (str): Folder of the project, packages containing it are part of the name.
+        fpath (str): Path of the Python file.
+
+    Returns:
+        str: The module name, e.g. `pkg.module` for `pkg/module.py` and `pkg` for `pkg/__init__.py`.
+
+    Raises:
+        None
+    """
+    root = os.path.abspath(root)
+    while os.path.isfile(os.path.join(root, '__init__.py')) and os.path.dirname(root) != root:
+        # Absolute imports of a package start at the folder containing it
+        root = os.path.dirname(root)
+
+    parts = os.path.splitext(os.path.relpath(os.path.abspath(fpath), root))[0].split(os.sep)
+    if parts[-1] == '__init__' and len(parts) > 1:
+        parts.pop()
+    return '.'.join(parts)
 
-    for node in tree.body:  # Iterate over the top-level nodes in the AST
-        
-        if isinstance(node, ast.FunctionDef) or isinstance(node, ast.ClassDef):  # Check if the node is a function or class definition
-            
-            extra_deps = []
-            if isinstance(node, ast.ClassDef):  # If the node is a class definition
-                for child_node in node.body:  # Iterate over the child nodes in the class body
-                    if isinstance(child_node, ast.FunctionDef):  # Check if the child node is a function definition
-                        extra_deps.append(child_node.name)
-                        funcs.add(
-                            child_node.name,
-                            {
-                                CodeData.CODE: ast.get_source_segment(code_str, child_node),  # Get the source segment for the child function
-                                CodeData.NODE: child_node,
-                                CodeData.DEP: get_func_calls(child_node),  # Get function calls within the child function
-                                CodeData.CUSTOM: True,
-                                CodeData.PATH: path,
-                                CodeData.CODE_INDENT: get_indent_from_file(path),  # Get the code indentation level from the file
-                                CodeData.TYPE: 'method',
-                            }
-                        )
-
-            funcs.add(
-                node.name,
-                {
-                    CodeData.CODE: ast.get_source_segment(code_str, node),  # Get the source segment for the function or class
-                    CodeData.NODE: node,
-                    CodeData.DEP: get_func_calls(node),  # Get function calls within the function or class
-                    CodeData.CUSTOM: True,
-                    CodeData.PATH: path,
-                    CodeData.TYPE: 'function' if isinstance(node, ast.FunctionDef) else 'class',
-                }
-            )
-
-            funcs.add(
-                node.name,
-                {
-                    CodeData.CODE: ast.get_source_segment(code_str, node),
-                    CodeData.NODE: node,
-                    CodeData.DEP: get_func_calls(node),
-                    CodeData.CUSTOM: True,
-                    CodeData.PATH: path,
-                    CodeData.TYPE: 'function' if isinstance(node, ast.FunctionDef) else 'class',
-                }
-            )
+
+class SymbolTable:
+    def __init__(self):
+        """
+        Initializes the table of the functions, classes and methods of a project, by fully qualified name
+        (e.g. `pkg.module.Class.method`), used to resolve the calls of each module.
+
+        Input:
+            None
+
+        Returns:
+            None
+
+        Raises:
+            None
+        """
+        self.symbols = set()
+        self.modules = {}  # Module name -> (is package, aliases)
+
+    def add_module(self, module, is_package, aliases, names):
+        """
+        Add the definitions and imports of a module.
+
+        Input:
+            module (str): Dotted name of the module.
+            is_package (bool): True for the `__init__.py` of a package, relative imports start at the package itself.
+            aliases (dict): Imported name -> [relative import level, imported dotted name],
+                            '*' -> list of [level, module] of the star imports.
+            names (list of str): Names of the functions/classes/methods of the module, e.g. `Class.method`.
+
+        Returns:
+            None
+
+        Raises:
+            None
+        """
+        self.modules[module] = (is_package, aliases)
+        self.symbols.update(f'{module}.{name}' for name in names)
+
+    def absolute_import(self, module, level, name):
+        """
+        Get the absolute dotted name of an import.
+
+        Input:
+            module (str): Module containing the import.
+            level (int): Number of leading dots of a relative import, 0 for an absolute import.
+            name (str): The imported dotted name, relative to the level.
+
+        Returns:
+            str: The absolute dotted name.
+
+        Raises:
+            None
+        """
+        if not level:
+            return name
+        is_package, _ = self.modules.get(module, (False, {}))
+        package = module.split('.')
+        package = package[:len(package) - level + is_package]
+        return '.'.join(package + ([name] if name else []))
+
+    def lookup(self, name, depth=0):
+        """
+        Find the definition of an absolute dotted name, following the names re-exported by imports (e.g. in `__init__.py`).
+
+        Input:
+            name (str): The absolute dotted name.
+            depth (int): Number of imports followed so far, to stop on import cycles.
+
+        Returns:
+            str: The fully qualified name of the definition, None if it is not part of the project.
+
+        Raises:
+            None
+        """
+        if name in self.symbols:
+            return name
+        if depth > 8:
+            return None
+
+        parts = name.split('.')
+        for i in range(len(parts) - 1, 0, -1):
+            module = '.'.join(parts[:i])
+            if module in self.modules:
+                _, aliases = self.modules[module]
+                if parts[i] in aliases and parts[i] != '*':
+                    level, target = aliases[parts[i]]
+                    return self.lookup('.'.join([self.absolute_import(module, level, target)] + parts[i + 1:]), depth + 1)
+                for level, star_module in aliases.get('*', []):
+                    qualified = self.lookup('.'.join([self.absolute_import(module, level, star_module)] + parts[i:]), depth + 1)
+                    if qualified:
+                        return qualified
+                break
+        return None
+
+    def resolve(self, call, module, owner):
+        """
+        Resolve a call to the function/class/method of the project it refers to.
+
+        Calls are resolved through the definitions and imports of the module, and through `self.`/`cls.` in a class.
+
+        Input:
+            call (str): The call as written, e.g. `self.run` or `np.array`.
+            module (str): Module containing the call.
+            owner (str): Name of the function/class/method containing the call within the module, e.g. `Class.method`.
+
+        Returns:
+            str: The fully qualified name of the definition, or the call unchanged if it is not part of the project.
+
+        Raises:
+            None
+        """
+        parts = call.split('.')
+        _, aliases = self.modules.get(module, (False, {}))
+
+        candidates = []
+        if parts[0] in ('self', 'cls') and len(parts) > 1:
+            candidates.append(f'{module}.{owner.split(".")[0]}.' + '.'.join(parts[1:]))
+        else:
+            candidates.append(f'{module}.{call}')
+            if parts[0] in aliases and parts[0] != '*':
+                level, target = aliases[parts[0]]
+                candidates.append('.'.join([self.absolute_import(module, level, target)] + parts[1:]))
+            for level, star_module in aliases.get('*', []):
+                candidates.append(f'{self.absolute_import(module, level, star_module)}.{call}')
+
+        for candidate in candidates:
+            qualified = self.lookup(candidate)
+            if qualified:
+                return qualified
+        return call
 
 
 def get_all_imports(code_str):
@@ -274,6 +592,290 @@ def parse_commented_function(func_name, func_str):
     return func_str, ast_code, success, reason
 
 
+COMMENT_LINE_PATTERN = re.compile(r'^\s*(\d+)\s*[:|]\s*(.*\S)\s*$')
+INDENT_PATTERN = re.compile(r'[ \t]*')
+
+
+def parse_docstring_output(output):
+    """
+    Split the output of a docstring-only prompt into the docstring and the inline comments.
+
+    Input:
+    output (str): The LLM output, starting with the contents of the docstring (the prompt already opens it).
+
+    Returns:
+    tuple:
+        - doc (str): The dedented docstring, None if the docstring was not closed.
+        - comments (dict): Comment text by (1-based) line number of the original code block.
+
+    Raises:
+    None
+    """
+    output = output.strip()
+    if output.startswith('"""'):
+        # The model repeated the opening quotes
+        output = output[3:]
+    if '"""' not in output:
+        return None, {}
+
+    doc, rest = output.split('"""', 1)
+    # Same normalization as `ast.get_docstring`, the first line may not be indented like the others
+    doc = '\n'.join(line.rstrip() for line in inspect.cleandoc(doc).split('\n'))
+
+    comments = {}
+    for line in rest.split('\n'):
+        match = COMMENT_LINE_PATTERN.match(line)
+        if match:
+            # Comments have to fit on a single line
+            comments[int(match.group(1))] = ' '.join(match.group(2).lstrip('#').split())
+    return doc, comments
+
+
+def format_docstring(doc, indent):
+    """
+    Format a docstring as the lines of a triple quoted string.
+
+    Input:
+    doc (str): The contents of the docstring.
+    indent (str): Indentation of the body the docstring is inserted into.
+
+    Returns:
+    list of str: Lines of the docstring, a raw string if it contains backslashes, in single quotes if it contains triple double quotes.
+
+    Raises:
+    None
+    """
+    quotes = "'''" if '"""' in doc and "'''" not in doc else '"""'
+    if quotes in doc:
+        # Both kinds of triple quotes, escape them (and the backslashes) in a regular string
+        prefix, doc = '', doc.replace('\\', '\\\\').replace(quotes, '\\' + quotes)
+    else:
+        prefix = 'r' if '\\' in doc else ''
+    return [f'{indent}{prefix}{quotes}'] + [f'{indent}{line}' if line.strip() else '' for line in doc.split('\n')] + [f'{indent}{quotes}']
+
+
+def splice_documentation(func_name, output, code_str, node):
+    """
+    Insert the docstring and inline comments of a docstring-only LLM output into the original code of a function/class.
+
+    Input:
+    func_name (str): Name of the function/class.
+    output (str): The LLM output of the docstring-only prompt.
+    code_str (str): The original code of the function/class, as given in the prompt.
+    node (ast.FunctionDef or ast.ClassDef): The original node of the function/class, positions are relative to its file.
+
+    Returns:
+    tuple: Same as `insert_documentation`
+
+    Raises:
+    None
+    """
+    doc, comments = parse_docstring_output(output)
+    if not doc:
+        return code_str, None, False, 'No docstring found in the output'
+    return insert_documentation(func_name, code_str, node, doc, comments)
+
+
+def insert_documentation(func_name, code_str, node, doc, comments=None, header_only=False):
+    """
+    Insert a docstring and inline comments into the original code of a function/class.
+
+    An existing docstring is replaced, comments are only inserted above the first line of a statement of a function.
+
+    Input:
+    func_name (str): Name of the function/class.
+    code_str (str): The original code of the function/class.
+    node (ast.FunctionDef or ast.ClassDef): The original node of the function/class, positions are relative to its file.
+    doc (str): The contents of the docstring.
+    comments (dict): Comment text by (1-based) line number of the original code, None for no comments.
+    header_only (bool): Only return the definition line(s) and the new docstring (the new version of `get_class_header`).
+
+    Returns:
+    tuple: Same as `parse_commented_function`
+        - func_str (str): The documented code.
+        - ast_code (ast.AST): The node of the documented code.
+        - success (bool): True if the documentation could be inserted.
+        - reason (str): Reason of the failure, None if successful.
+
+    Raises:
+    None
+    """
+    first = node.body[0]
+    if first.lineno == node.lineno:
+        return code_str, None, False, 'Can not insert a docstring into a single line definition'
+
+    lines = code_str.split('\n')
+    # Line indices relative to the code block, the docstring goes above the first statement (and its decorators)
+    start = min([first.lineno] + [dec.lineno for dec in getattr(first, 'decorator_list', [])]) - node.lineno
+    has_docstring = isinstance(first, ast.Expr) and isinstance(first.value, ast.Constant) and isinstance(first.value.value, str)
+    end = first.end_lineno - node.lineno + 1 if has_docstring else start
+    indent = INDENT_PATTERN.match(lines[start]).group(0)
+
+    insertions = {}
+    if comments and not isinstance(node, ast.ClassDef):
+        stmt_lines = {child.lineno - node.lineno for child in ast.walk(node) if isinstance(child, ast.stmt) and child is not node}
+        insertions = {line_no - 1: comment for line_no, comment in comments.items() if line_no - 1 in stmt_lines and line_no - 1 >= end}
+        if len(insertions) < len(comments):
+            logging.debug(f'\t\tDropped {len(comments) - len(insertions)} comments of `{func_name}` that are not above a statement')
+
+    # The docstring goes right below the definition line(s), comment lines above the first statement stay below it, and
+    # so do blank lines unless they only separated the definition from the replaced docstring
+    head = start
+    while head > 1 and (not lines[head - 1].strip() or lines[head - 1].strip().startswith('#')):
+        head -= 1
+    moved = [line for line in lines[head:start] if line.strip() or not has_docstring]
+
+    new_lines = lines[:head] + format_docstring(doc, indent) + moved
+    for i in range(end, start if header_only else len(lines)):
+        if i in insertions:
+            new_lines.append(f'{INDENT_PATTERN.match(lines[i]).group(0)}# {insertions[i]}')
+        new_lines.append(lines[i])
+    func_str = '\n'.join(new_lines)
+
+    try:
+        ast_code = ast.parse(func_str).body[0]
+    except SyntaxError as e:
+        return func_str, None, False, f'Parse error `({repr(e)[:50]}...)`'
+
+    return func_str, ast_code, True, None
+
+
+def indent_code(code_str, node, indent):
+    """
+    Indent generated code so that it replaces code whose definition line is indented by `indent`.
+
+    Input:
+    code_str (str): The generated code, its definition line is not indented.
+    node (ast.FunctionDef or ast.ClassDef): The node of the generated code.
+    indent (str): Indentation of the original definition line.
+
+    Returns:
+    str: The indented code.
+
+    Raises:
+    None
+    """
+    first = node.body[0]
+    if first.lineno > node.lineno and first.col_offset > len(indent):
+        # The body kept the indentation of the original code, only the definition line has to be indented
+        return indent + code_str
+    return '\n'.join(indent + line if line.strip() else line for line in code_str.split('\n'))
+
+
+def get_class_header(code_str, node):
+    """
+    Get the header of a class: its definition line(s) and its existing docstring, if any.
+
+    Input:
+    code_str (str): The original code of the class.
+    node (ast.ClassDef): The original node of the class.
+
+    Returns:
+    str: The lines of the code up to the first statement of the class body that is not its docstring.
+
+    Raises:
+    None
+    """
+    first = node.body[0]
+    if first.lineno == node.lineno:
+        # Single line classes have no separate header
+        return code_str
+
+    if isinstance(first, ast.Expr) and isinstance(first.value, ast.Constant) and isinstance(first.value.value, str):
+        end = first.end_lineno - node.lineno + 1
+    else:
+        end = min([first.lineno] + [dec.lineno for dec in getattr(first, 'decorator_list', [])]) - node.lineno
+    return '\n'.join(code_str.split('\n')[:end])
+
+
+def get_class_skeleton(node, method_docs):
+    """
+    Get the skeleton of a class: its definition, class attributes and the signatures and docstrings of its methods.
+
+    Input:
+    node (ast.ClassDef): The original node of the class.
+    method_docs (dict): Docstring by method name, used instead of the existing docstring of a method if not '-'.
+
+    Returns:
+    str: Source of the class with the body of every method (and nested class method) replaced by its docstring and `...`.
+
+    Raises:
+    None
+    """
+    skeleton = copy.deepcopy(node)
+    for child in ast.walk(skeleton):
+        if isinstance(child, (ast.FunctionDef, ast.AsyncFunctionDef)) and child.body:
+            doc = method_docs.get(child.name, '-')
+            doc = doc if doc and doc != '-' else ast.get_docstring(child, clean=False)
+            child.body = ([ast.Expr(ast.Constant(doc))] if doc else []) + [ast.Expr(ast.Constant(...))]
+    return ast.unparse(skeleton)
+
+
+def ast_fingerprint(node, all_docstrings=False):
+    """
+    Hash the structure of a function/class without its docstring, without copying the node.
+
+    Equal nodes (as compared by `same_ast`, ignoring positions and `ctx`) have equal fingerprints, so comparing
+    fingerprints is enough to verify that two nodes are the same.
+
+    Input:
+    node (ast.AST): The function/class node.
+    all_docstrings (bool): True to also leave out the docstrings of all functions/classes nested in it, like `remove_all_docstrings`.
+
+    Returns:
+    str: SHA-256 hex digest of the node, unchanged by edits to docstrings, comments or formatting.
+
+    Raises:
+    None
+    """
+    digest = hashlib.sha256()
+
+    def visit(value, strip):
+        if isinstance(value, ast.AST):
+            digest.update(f'{type(value).__name__}('.encode('utf-8'))
+            for field in value._fields:
+                if field == 'ctx':
+                    continue
+                child = getattr(value, field, None)
+                if field == 'body' and strip and isinstance(child, list):
+                    # Same statements as the ones left by `remove_docstring`
+                    child = [stmt for stmt in child if not (isinstance(stmt, ast.Expr) and isinstance(stmt.value, ast.Constant))]
+                digest.update(f'{field}='.encode('utf-8'))
+                visit(child, all_docstrings and isinstance(child, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)))
+            digest.update(b')')
+        elif isinstance(value, list):
+            digest.update(b'[')
+            for item in value:
+                visit(item, all_docstrings and isinstance(item, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)))
+                digest.update(b',')
+            digest.update(b']')
+        else:
+            digest.update(f'{type(value).__name__}:{value!r};'.encode('utf-8'))
+
+    visit(node, True)
+    return digest.hexdigest()
+
+
+def remove_all_docstrings(node):
+    """
+    Remove the docstrings of a function/class and of all functions/classes nested in it.
+
+    Input:
+    node (ast.AST): The function/class node.
+
+    Returns:
+    ast.AST: A copy of the node without docstrings.
+
+    Raises:
+    None
+    """
+    node_copy = remove_docstring(node)
+    for child in ast.walk(node_copy):
+        if isinstance(child, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+            child.body = [stmt for stmt in child.body if not (isinstance(stmt, ast.Expr) and isinstance(stmt.value, ast.Constant))]
+    return node_copy
+
+
 def remove_docstring(func_node):
     """
     Remove the docstring from an AST function node.
@@ -385,165 +987,31 @@ def same_ast_with_reason(node1: Union[ast.expr, list[ast.expr]], node2: Union[as
             else:
                 return False, f'[NODE] `{type(node1)}` (`{node1}`) != `{type(node2)}` (`{node2}`)'
 
-def remove_comments_from_line(line):
-    """
-    Remove comments from a given line of code.
-
-    Input:
-    - line (str): A single line of code which may contain comments starting with '#'.
-
-    Returns:
-    - str: The line of code with the comments removed.
-
-    Raises:
-    - None
-    """
-    # Use regular expression to find and remove comments from the line
-    return re.sub('#+[\s]*.*\n*$', '', line)
-
-
-py_clean = lambda x: remove_comments_from_line(x.lstrip('\t').strip()).lstrip('\t').strip()
-
-empty_line = lambda x: False if x.replace('\n', '').replace('\t', '').strip() else True
-
-clean_code_lines = lambda clines: [(i,py_clean(cline)) for i,cline in enumerate(clines) if not empty_line(py_clean(cline))]
-
-
-def replace_func_single_line(func_name, orig_code_lines, new_code_lines, file_path, flines):
-    """
-    Replaces a function definition in a file with new code lines.
-
-    Input:
-    - func_name (str): The name of the function to be replaced.
-    - orig_code_lines (list): The original code lines of the function.
-    - new_code_lines (list): The new code lines to replace the original function.
-    - file_path (str): The path to the file where the function resides.
-    - flines (list): The lines of the file where the function resides.
-
-    Returns:
-    - new_flines (list): The updated lines of the file after the function has been replaced.
-
-    Raises:
-    - Logs an error if the function cannot be found and replaced in the specified file.
-    """
-
-    cleaned_orig_code_lines = clean_code_lines(orig_code_lines)
-    cleaned_flines = clean_code_lines(flines)
-    
-    first_line, last_line = cleaned_orig_code_lines[0][1], cleaned_orig_code_lines[-1][1]
-    
-    start_ind, end_ind = -1, -1
-    for (ind,fline) in cleaned_flines:        
-        # Find the start index of the function's first line
-        if fline == first_line:
-            start_ind = ind
-        # Find the end index of the function's last line
-        if start_ind != -1 and fline == last_line:
-            end_ind = ind
-            break
-        
-    if start_ind == -1 or end_ind == -1:
-        # Log an error if the function's start or end couldn't be found
-        logging.error(f'Could not replace `{func_name}` in file `{file_path} (Start: {start_ind}, End: {end_ind})')
-        new_flines = flines
-    else:
-        # Replace the function's lines in the file
-        new_flines = flines[:start_ind] + new_code_lines + flines[end_ind+1:]
-        
-    return new_flines
-
-
-def replace_func_double_line(func_name, orig_code_lines, new_code_lines, file_path, flines):
-    """
-    Replace specific lines of a function in a file with new lines of code.
-
-    Input:
-        func_name (str): The name of the function to be replaced.
-        orig_code_lines (list): List of tuples where each tuple contains an index and a line of code from the original function.
-        new_code_lines (list): List of new code lines to replace the original function lines.
-        file_path (str): The file path where the function is located.
-        flines (list): List of tuples where each tuple contains an index and a line of code from the file.
-
-    Returns:
-        new_flines (list): The file lines after replacing the necessary function lines with new code lines.
-
-    Raises:
-        Logs an error if the function lines to be replaced cannot be found in the file.
-    """
-            
-    cleaned_orig_code_lines = clean_code_lines(orig_code_lines)
-    cleaned_flines = clean_code_lines(flines)
-    
-    # Extract the first, second last, and last line of the function to be replaced
-    first_line, second_last_line, last_line = cleaned_orig_code_lines[0][1], cleaned_orig_code_lines[-2][1], cleaned_orig_code_lines[-1][1]
-    
-    start_ind, end_ind = -1, -1
-    n = len(cleaned_flines)
-    for i in range(n-1):
-        ind, fline = cleaned_flines[i]
-        ind_next, fline_next = cleaned_flines[i+1]
-        
-        if fline == first_line:
-            start_ind = ind  # Detecting the start of the function
-        if start_ind != -1 and fline == second_last_line and fline_next == last_line:
-            end_ind = ind_next  # Detecting the end of the function
-            break
-        
-    if start_ind == -1 or end_ind == -1:
-        logging.error(f'Could not replace `{func_name}` in file `{file_path} (Start: {start_ind}, End: {end_ind})')
-        new_flines = flines  # If the function is not found, retain the original file lines
-    else:
-        new_flines = flines[:start_ind] + new_code_lines + flines[end_ind+1:]  # Replace the function lines with new lines
-        
-    return new_flines
-
-
-def replace_func(func_name, orig_code_str, new_code_str, file_path, f_str):
-    """
-    Replace a function's code in a file with new code.
-    
-    Input:
-    - func_name: The name of the function to be replaced.
-    - orig_code_str: The original code of the function as a string.
-    - new_code_str: The new code to replace the original code with as a string.
-    - file_path: The path to the file containing the function.
-    - f_str: The entire content of the file as a single string.
-    
-    Returns:
-    - A string representing the entire content of the file with the function replaced.
-    
-    Raises:
-    - This function does not raise any exceptions directly but relies on sub-functions that might raise exceptions.
-    """
-    
-    orig_code_lines = orig_code_str.split('\n')
-    new_code_lines = new_code_str.split('\n')
-    num_code_lines = len(orig_code_lines)
-    flines = f_str.split('\n')
-    
-    if num_code_lines <= 2:
-        # Handle replacement for functions with only one or two lines of code
-        return '\n'.join(replace_func_single_line(func_name, orig_code_lines, new_code_lines, file_path, flines))
-    else:
-        # Handle replacement for functions with more than two lines of code
-        return '\n'.join(replace_func_double_line(func_name, orig_code_lines, new_code_lines, file_path, flines))
-
-
-def get_indent_from_file(path):
+def splice_code(edits, file_path, buf):
     """
-    Retrieve the indentation string from a Python source file.
+    Replace the code of several functions/classes/methods of a file in a single pass, from the bottom of the file up,
+    so that the byte offsets of the edits that are not applied yet stay valid.
 
     Input:
-    - path (str): The path to the Python source file.
+    - edits (list of tuple): (func_name, start, end, new_code_str) of every replacement, with the byte offsets of the
+      replaced code in `buf`.
+    - file_path (str): The path to the file containing the functions.
+    - buf (bytes): The content of the file.
 
     Returns:
-    - str: The string used for indentation (tabs or spaces) in the file.
+    - bytes: The content of the file with the code replaced, keeping the line endings of the file.
 
     Raises:
-    - Logs an error if no indentation is found in the file.
+    - Logs an error if an edit overlaps another one, it is left out.
     """
-    with open(path) as f:
-        for (tok_type, tok_str, _, _, _) in tokenize.generate_tokens(f.readline):
-            if tok_type == tokenize.INDENT:
-                return tok_str  # Return the indentation string if found
-    logging.error(f'Could not find indent (tabs/spaces) from path: `{path}`')  # Log an error if indentation is not found
\ No newline at end of file
+    newline = '\r\n' if b'\r\n' in buf else '\n'
+    parts, limit = [], len(buf)
+    for func_name, start, end, new_code_str in sorted(edits, key=lambda edit: edit[1], reverse=True):
+        if end > limit:
+            logging.error(f'Could not replace `{func_name}` in file `{file_path}` (Overlaps another replaced function)')
+            continue
+        parts.append(buf[end:limit])
+        parts.append(new_code_str.replace('\n', newline).encode('utf-8'))
+        limit = start
+    parts.append(buf[:limit])
+    return b''.join(reversed(parts))
@@ -1,16 +1,25 @@
-from python_parsers import get_all_calls, get_all_imports, parse_commented_function, same_ast_with_reason, remove_docstring, replace_func
-from get_code_docs import CodeData, get_reference_docs_custom_functions, get_shortened_docs
-from prompts import SYSTEM_PROMPT, DOC_GENERATION_PROMPT
-from constants import TOK_COUNT
-from llm_inference import get_llm_output
-
+from python_parsers import DEFAULT_CALL_FILTER, SymbolTable, extract_file, get_module_name, parse_commented_function, parse_docstring_output, splice_documentation, insert_documentation, same_ast_with_reason, remove_docstring, remove_all_docstrings, ast_fingerprint, splice_code, indent_code, get_class_header, get_class_skeleton
+from get_code_docs import CodeData, read_segment, get_reference_docs_custom_functions, get_shortened_docs
+from prompts import SYSTEM_PROMPT, DOC_GENERATION_PROMPT, DOC_ONLY_GENERATION_PROMPT, build_doc_generation_prompt, estimate_tokens
+from constants import TOK_COUNT, CONNECT_TIMEOUT, READ_TIMEOUT, API_RETRIES, CACHE_DIR, CACHE_SIZE_MB, SUMMARIZE_BATCH_TOKENS, CONTEXT_SIZE, REFERENCE_LOOKUP, GENERATION, VERIFICATION
+from llm_inference import get_llm_candidates, cache_output
+from llm_cache import get_cache
+from parse_cache import get_parse_cache, hash_code
+from metrics import get_metrics
+from incremental import get_manifest_path, get_manifest_key, hash_ref_docs, load_manifest, save_manifest
+
+from contextlib import closing
+from itertools import repeat
 import argparse
 from argparse import RawTextHelpFormatter
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
 import pandas as pd
 import logging
 import ast
 import os
-import math
+import stat
+import tempfile
+import time
 import re
 
 
@@ -61,7 +70,14 @@ def get_args():
     parser.add_argument(
         "-p", "--port",
         type=int,
-        help="Port where Local LLM server is hosted"
+        action='append',
+        help="Port where a Local LLM server is hosted, repeat it for several servers, requests are spread over all of them"
+    )
+
+    parser.add_argument(
+        "--endpoint",
+        action='append',
+        help="Base URL of an OpenAI compatible LLM server, e.g. http://gpu-1:8080/v1, repeat it for several servers, used together with --port"
     )
         
     parser.add_argument(
@@ -74,13 +90,44 @@ def get_args():
             \nfull        - Use the complete documentation (Can lead to very long context length)\
             \n\"truncate\" is used as the default strategy"
     )
+
+    parser.add_argument(
+        "--summarize_batch_tokens",
+        type=int,
+        default=SUMMARIZE_BATCH_TOKENS,
+        help=f"Maximum number of (estimated) tokens of reference documentation summarized in a single request\
+            \nUsed with --ref_doc summarize ({SUMMARIZE_BATCH_TOKENS} by default, 0 summarizes each documentation separately)"
+    )
     
+    parser.add_argument(
+        "--context_size",
+        type=int,
+        default=CONTEXT_SIZE,
+        help=f"Context window of the LLM in tokens, reference documentation is trimmed so that prompts fit\
+            \n({CONTEXT_SIZE} by default, 0 disables trimming)"
+    )
+
     parser.add_argument(
         "--max_retries",
         type=int,
         default=3,
         help="Number of attempts that the LLM gets to generate the documentation for each function/method/class"
     )
+
+    parser.add_argument(
+        "--doc_only",
+        action='store_true',
+        help="Only ask the LLM for the docstring (and inline comments by line number) instead of the whole documented code\
+            \nThe documentation is inserted into the original code, which uses far fewer completion tokens"
+    )
+
+    parser.add_argument(
+        "--candidates",
+        type=int,
+        default=1,
+        help="Number of attempts of --max_retries that are requested at once, the first one that passes verification is used\
+            \nTrades tokens for latency (1 by default, i.e. one attempt at a time)"
+    )
     
     parser.add_argument(
         "--temperature",
@@ -96,6 +143,139 @@ def get_args():
         help="Maximum number of tokens that the LLM is allowed to generate"
     )
 
+    parser.add_argument(
+        "-j", "--jobs",
+        type=int,
+        default=1,
+        help="Number of functions/methods/classes that are documented in parallel"
+    )
+
+    parser.add_argument(
+        "--scan_jobs",
+        type=int,
+        default=1,
+        help="Number of processes that parse the Python files of the project in parallel"
+    )
+
+    parser.add_argument(
+        "--low_memory",
+        action='store_true',
+        help="Only keep the position of the code of every function/method/class, it is read from the files when needed"
+    )
+
+    parser.add_argument(
+        "--ignore_file",
+        help="File with more names of calls that are not documented or used as reference, one per line (# starts a comment)"
+    )
+
+    parser.add_argument(
+        "--ignore_builtins",
+        action='store_true',
+        help="Do not document or look up references of builtins and of `str`, `list` and `dict` methods"
+    )
+
+    parser.add_argument(
+        "--max_connections",
+        type=int,
+        help="Maximum number of keep-alive connections to the LLM server (defaults to --jobs x --candidates)"
+    )
+
+    parser.add_argument(
+        "--connect_timeout",
+        type=float,
+        default=CONNECT_TIMEOUT,
+        help=f"Seconds to wait while connecting to the LLM server ({CONNECT_TIMEOUT} by default)"
+    )
+
+    parser.add_argument(
+        "--read_timeout",
+        type=float,
+        default=READ_TIMEOUT,
+        help=f"Seconds to wait for a response from the LLM server ({READ_TIMEOUT} by default)"
+    )
+
+    parser.add_argument(
+        "--rpm",
+        type=float,
+        help="Maximum number of LLM requests per minute (not limited by default)"
+    )
+
+    parser.add_argument(
+        "--tpm",
+        type=float,
+        help="Maximum number of LLM tokens (prompt + max_tokens) per minute (not limited by default)"
+    )
+
+    parser.add_argument(
+        "--api_retries",
+        type=int,
+        default=API_RETRIES,
+        help=f"Number of times a rate limited or failed LLM request is retried with exponential backoff ({API_RETRIES} by default)\
+            \nThese retries are independent of --max_retries"
+    )
+
+    parser.add_argument(
+        "--stream",
+        action='store_true',
+        help="Stream completions from the LLM and stop reading as soon as the documented code block is complete"
+    )
+
+    parser.add_argument(
+        "--no_cache",
+        action='store_true',
+        help="Do not read or store LLM responses in the on-disk response cache\
+            \nOnly generated documentation that passes verification is cached, failed attempts are requested again on the next run"
+    )
+
+    parser.add_argument(
+        "--cache_path",
+        default=os.path.join(CACHE_DIR, 'llm_cache.sqlite'),
+        help="Path of the on-disk LLM response cache (stored in ~/.cache/lmdocs by default)"
+    )
+
+    parser.add_argument(
+        "--cache_size",
+        type=float,
+        default=CACHE_SIZE_MB,
+        help=f"Maximum size of the LLM response cache in MB, least recently used responses are evicted first ({CACHE_SIZE_MB} by default)"
+    )
+
+    parser.add_argument(
+        "--no_parse_cache",
+        action='store_true',
+        help="Do not read or store the functions/classes/methods extracted from each file in the on-disk parse cache"
+    )
+
+    parser.add_argument(
+        "--parse_cache_path",
+        default=os.path.join(CACHE_DIR, 'parse_cache.sqlite'),
+        help="Path of the on-disk parse cache, files are parsed again when their content changes (stored in ~/.cache/lmdocs by default)"
+    )
+
+    parser.add_argument(
+        "--incremental",
+        action='store_true',
+        help="Only document functions/methods/classes that changed since the last incremental run\
+            \nThe documentation of every run is stored in a manifest for the next one"
+    )
+
+    parser.add_argument(
+        "--manifest_path",
+        help="Path of the manifest used by --incremental (.lmdocs_manifest.json in the project folder by default)"
+    )
+
+    parser.add_argument(
+        "--metrics_path",
+        help="Export the time, tokens, LLM requests, retries and cache hits of every pipeline stage and function to this file"
+    )
+
+    parser.add_argument(
+        "--metrics_format",
+        choices=['json', 'prometheus'],
+        default='json',
+        help="Format of --metrics_path, JSON or a Prometheus textfile (json by default)"
+    )
+
     args = parser.parse_args()
     verify_args(args)
     
@@ -108,7 +288,8 @@ def verify_args(args):
 
     Input:
     - args: An object containing command line arguments. It should have attributes:
-        - port: Port number for local LLM (optional if using OpenAI).
+        - port: Port numbers for local LLMs (optional if using OpenAI).
+        - endpoint: Base URLs of local LLMs (optional if using OpenAI).
         - openai_key: API key for OpenAI LLM (optional if using local LLM).
         - openai_key_env: Environment variable name for OpenAI API key (optional if using local LLM).
         - openai_model: Specific model to be used from OpenAI (optional).
@@ -117,19 +298,39 @@ def verify_args(args):
     - None
 
     Raises:
-    - argparse.ArgumentError: Raised if neither 'port' nor 'openai_key'/'openai_key_env' is provided.
+    - argparse.ArgumentError: Raised if neither 'port'/'endpoint' nor 'openai_key'/'openai_key_env' is provided.
                              Raised if 'openai_model' is specified without 'openai_key' or 'openai_key_env'.
     """
     parser = argparse.ArgumentParser()
 
-    # Check if neither local port nor OpenAI keys are provided
-    if not args.port and not args.openai_key and not args.openai_key_env:
-        raise parser.error('Use --port for a local LLM or --openai_key/--openai_key_env for openAI LLMs')
+    # Check if neither local server nor OpenAI keys are provided
+    if not args.port and not args.endpoint and not args.openai_key and not args.openai_key_env:
+        raise parser.error('Use --port/--endpoint for a local LLM or --openai_key/--openai_key_env for openAI LLMs')
 
     # Check if an OpenAI model is specified without providing necessary keys
-    if not args.port and (args.openai_model and not (args.openai_key or args.openai_key_env)):
+    if not args.port and not args.endpoint and (args.openai_model and not (args.openai_key or args.openai_key_env)):
         raise parser.error('One of --openai_key or --openai_key_env must be specified')
 
+    # Check that at least one worker is used to generate the documentation
+    if args.jobs < 1:
+        raise parser.error('--jobs must be at least 1')
+
+    # Check that the ignore file exists before scanning the project
+    if args.ignore_file and not os.path.isfile(args.ignore_file):
+        raise parser.error(f'--ignore_file `{args.ignore_file}` does not exist')
+
+    # Check that at least one process is used to scan the project
+    if args.scan_jobs < 1:
+        raise parser.error('--scan_jobs must be at least 1')
+
+    # Check that at least one candidate is requested at a time
+    if args.candidates < 1:
+        raise parser.error('--candidates must be at least 1')
+
+    # Check that the context leaves room for the prompt after the system prompt and the completion
+    if args.context_size and args.context_size <= estimate_tokens(SYSTEM_PROMPT) + args.max_tokens:
+        raise parser.error(f'--context_size must be larger than --max_tokens plus the ~{estimate_tokens(SYSTEM_PROMPT)} tokens of the system prompt')
+
 
 def generate_report(code_deps, report_path):
     """
@@ -149,15 +350,23 @@ def generate_report(code_deps, report_path):
     
     data = []  # Initialize an empty list to store formatted data
 
+    functions = get_metrics().functions
+
     for k, v in code_deps.items():  # Iterate over each item in the code dependencies
         if v[CodeData.CUSTOM]:  # Check if the code is marked as custom
+            func_metrics = functions.get(k, {})  # Time, tokens and tries recorded while documenting it
             data.append({
                 'path': v['path'],
                 'function': k,  # Function name
                 'documentation': v[CodeData.DOC],  # Full documentation string
                 'shortened documentation': v[CodeData.DOC_SHORT],  # Shortened documentation string
-                'code_before': v[CodeData.CODE],  # Original code
-                'code_after': v[CodeData.CODE_NEW]  # Modified code
+                'code_before': code_deps.code(k),  # Original code
+                'code_after': v[CodeData.CODE_NEW],  # Modified code
+                'seconds': func_metrics.get('seconds'),
+                **{tok: func_metrics.get(tok) for tok in TOK_COUNT},
+                'tries': func_metrics.get('tries'),
+                'reused': func_metrics.get('reused'),
+                'failure_reason': func_metrics.get('failure_reason'),
             })
         
     # Convert the list of dictionaries into a DataFrame and save it as a CSV file
@@ -166,12 +375,43 @@ def generate_report(code_deps, report_path):
 
 is_hidden_dir = lambda path: any([dir.startswith('.') for dir in path.split('/')])
 
-def get_code_dependancies_and_imports(path):
+def scan_file(fpath, call_filter=DEFAULT_CALL_FILTER):
+    """
+    Read a Python file and extract its import statements, functions, classes and methods.
+
+    Runs in the worker processes of the project scan, so the result only contains picklable objects.
+
+    Input:
+        fpath (str): Path of the Python file.
+        call_filter (CallFilter): Filter of the calls that are left out of the dependencies.
+
+    Returns:
+        tuple:
+            - result (tuple): The import statements, imported names and (name, data) of the functions/classes/methods of the file.
+            - digest (str): Hash of the code of the file, for the parse cache.
+
+    Raises:
+        SyntaxError: If the file is not valid Python code.
+    """
+    with open(fpath, 'rb') as f:
+        code_str = f.read().decode('utf-8')  # Read the code from the file, keeping its line endings for the byte offsets
+
+    # Collect import statements, functions/classes/methods and their calls in a single pass
+    return extract_file(fpath, code_str, call_filter), hash_code(code_str)
+
+
+def get_code_dependancies_and_imports(path, scan_jobs=1, call_filter=DEFAULT_CALL_FILTER, low_memory=False):
     """
     Extracts code dependencies and import statements from Python files in a given directory or a single file.
 
+    Files are parsed by `scan_jobs` processes and merged in sorted path order, so the result does not depend on the
+    number of processes. Unchanged files are loaded from the parse cache instead of being parsed.
+
     Input:
         path (str): The path to a directory containing Python files or a single Python file.
+        scan_jobs (int): Number of processes that parse the files in parallel.
+        call_filter (CallFilter): Filter of the calls that are left out of the dependencies.
+        low_memory (bool): Only keep the position of the code of every function/class/method, see `CodeData.code`.
 
     Returns:
         tuple: A tuple containing:
@@ -181,128 +421,403 @@ def get_code_dependancies_and_imports(path):
     Raises:
         Exception: If the path is neither a directory nor a Python file.
     """
-    import_stmts = []  # List to hold import statements
+    import_stmts = {}  # Unique import statements, in the order they are found
     code_dependancies = CodeData()  # Object to hold code dependencies
     
     if os.path.isdir(path):
-        # If the path is a directory, walk through it
+        # If the path is a directory, collect every visible Python file in it
+        fpaths = []
         for root, _, files in os.walk(path):
             for file in files:
                 fpath = os.path.join(root, file)  # Full path to the file
                 if not is_hidden_dir(fpath.replace(path,"")) and os.path.splitext(file)[-1] == '.py':
-                    # Check if the file is a visible Python file
-                    logging.info(f'Extracting dependancies from {fpath}')  # Log the file being processed
-                    
-                    with open(fpath) as f:    
-                        code_str = f.read()  # Read the code from the file
-                        
-                    import_stmts.extend(get_all_imports(code_str)[2])  # Collect import statements
-                    get_all_calls(fpath, code_str, code_dependancies)  # Collect function calls and dependencies
-                    
+                    fpaths.append(fpath)
     elif os.path.splitext(path)[-1] == '.py':
         # If the path is a single Python file
-        logging.info(f'Extracting dependancies from {path}')  # Log the file being processed
-        
-        with open(path) as f:    
-            code_str = f.read()  # Read the code from the file
-        
-        import_stmts.extend(get_all_imports(code_str)[2])  # Collect import statements
-        get_all_calls(path, code_str, code_dependancies)  # Collect function calls and dependencies
-        
+        fpaths = [path]
     else:
         raise Exception(f'Could not parse path: `{path}`')  # Raise an exception if the path is invalid
+    fpaths.sort()  # os.walk order depends on the file system
+
+    # Look up every file in the parse cache, only the files that changed are parsed
+    cache = get_parse_cache()
+    cached, stats = {}, {}
+    for fpath in fpaths:
+        if cache:
+            cached[fpath], stats[fpath] = cache.get(fpath)
+    to_parse = [fpath for fpath in fpaths if cached.get(fpath) is None]
+
+    if scan_jobs > 1 and len(to_parse) > 1:
+        # Parse the files in worker processes, `map` yields the results in the order of the files
+        executor = ProcessPoolExecutor(max_workers=min(scan_jobs, len(to_parse)))
+        parsed = executor.map(scan_file, to_parse, repeat(call_filter), chunksize=max(1, len(to_parse) // (scan_jobs * 4)))
+    else:
+        executor = None
+        parsed = map(scan_file, to_parse, repeat(call_filter))
+
+    results = []
+    try:
+        for fpath in fpaths:
+            result = cached.get(fpath)
+            if result is None:
+                logging.info(f'Extracting dependancies from {fpath}')  # Log the file being processed
+                result, digest = next(parsed)
+                if cache:
+                    cache.put(fpath, stats[fpath], digest, result)
+            else:
+                logging.debug(f'Loaded dependancies of {fpath} from the parse cache')
+
+            if low_memory:
+                # Only the byte offsets of the code are kept, it is read from the file when needed
+                for _, data in result[2]:
+                    data[CodeData.CODE] = '-'
+            results.append((fpath, result))
+    finally:
+        if executor:
+            executor.shutdown(cancel_futures=True)
+
+    # Name every function/class/method by module, so that definitions with the same name in different files are kept apart
+    root = path if os.path.isdir(path) else os.path.dirname(path)
+    symbol_table = SymbolTable()
+    modules = [get_module_name(root or '.', fpath) for fpath, _ in results]
+    for module, (fpath, (_, aliases, blobs)) in zip(modules, results):
+        symbol_table.add_module(module, os.path.basename(fpath) == '__init__.py', aliases, [name for name, _ in blobs])
+
+    for module, (fpath, (file_import_stmts, _, blobs)) in zip(modules, results):
+        import_stmts.update(dict.fromkeys(file_import_stmts))  # Remove duplicates from import statements
+        for name, data in blobs:
+            # Calls to the project are resolved to the qualified name of their definition
+            deps = dict.fromkeys(symbol_table.resolve(call, module, name) for call in data[CodeData.DEP])
+            code_dependancies.add(f'{module}.{name}', {**data, CodeData.DEP: list(deps), CodeData.PATH: fpath})
+
+    if cache:
+        cache.commit()
+        get_metrics().add(parse_cache_hits=cache.hits, parse_cache_misses=cache.misses)
+        logging.info(cache.stats())
     
-    import_stmts = list(set(import_stmts))  # Remove duplicates from import statements
-    
-    return code_dependancies, import_stmts
+    return code_dependancies, list(import_stmts)
+
+
+def get_fingerprint(func, code_dependancies):
+    """
+    Get the fingerprint of the original code of a function/method/class, computed once and stored in the code data.
+
+    The fingerprint of a class is that of its skeleton without any docstring, which is all that its prompt contains.
+
+    Input:
+        func (str): Name of the function/method/class.
+        code_dependancies (CodeData): Code data containing the original code of `func`.
+
+    Returns:
+        str: The fingerprint, see `ast_fingerprint`.
+
+    Raises:
+        None
+    """
+    blob = code_dependancies[func]
+    if blob[CodeData.FINGERPRINT] is None:
+        node = code_dependancies.node(func)
+        if isinstance(node, ast.ClassDef):
+            blob[CodeData.FINGERPRINT] = ast_fingerprint(ast.parse(get_class_skeleton(node, {})).body[0], all_docstrings=True)
+        else:
+            blob[CodeData.FINGERPRINT] = ast_fingerprint(node)
+    return blob[CodeData.FINGERPRINT]
+
+
+def check_llm_output(func, llm_out, code_dependancies, skeleton=None, doc_only=False):
+    """
+    Parse an LLM output and verify that it only adds documentation to the code of a function/method/class.
+
+    Input:
+        func (str): Name of the function/method/class.
+        llm_out (str): The output of the LLM.
+        code_dependancies (CodeData): Code data containing the original code and node of `func`.
+        skeleton (str): Skeleton of the class sent in the prompt, None for functions/methods.
+        doc_only (bool): True if the LLM was asked for the docstring only.
+
+    Returns:
+        tuple:
+            - code (str): The documented code, only the header and docstring for a class
+            - node (ast.AST): The node of the documented code
+            - success (bool): True if the output is valid
+            - reason (str): Reason of the failure, None if successful
+
+    Raises:
+        None
+    """
+    code, node = code_dependancies.code(func), code_dependancies.node(func)
+
+    if skeleton is not None:
+        # Only the docstring of a class is written back, its methods are documented on their own
+        if doc_only:
+            doc, _ = parse_docstring_output(llm_out)
+        else:
+            _, new_node, success, reason = parse_commented_function(func, llm_out)
+            if not success:
+                return code, None, False, reason
+
+            if ast_fingerprint(new_node, all_docstrings=True) != get_fingerprint(func, code_dependancies):
+                # Only walk both trees to find the difference when the fingerprints do not match
+                same, ast_reason = same_ast_with_reason(remove_all_docstrings(ast.parse(skeleton).body[0]), remove_all_docstrings(new_node))
+                if not same:
+                    return code, None, False, f'AST mismatch: {ast_reason}'
+            doc = ast.get_docstring(new_node)
+
+        if not doc:
+            return code, None, False, 'No docstring found in the output'
+        return insert_documentation(func, code, node, doc, header_only=True)
+
+    if doc_only:
+        # Insert the generated docstring and comments into the original code
+        new_code, new_node, success, reason = splice_documentation(func, llm_out, code, node)
+    else:
+        # Parse the commented function output from the language model
+        new_code, new_node, success, reason = parse_commented_function(func, llm_out)
+    if not success:
+        return new_code, new_node, False, reason
+
+    # Compare the abstract syntax tree (AST) of the original and the new function, walking both trees only to find a difference
+    if ast_fingerprint(new_node) != get_fingerprint(func, code_dependancies):
+        same, ast_reason = same_ast_with_reason(remove_docstring(node), remove_docstring(new_node))
+        if not same:
+            return new_code, new_node, False, f'AST mismatch: {ast_reason}'
+    return new_code, new_node, True, None
+
+
+def document_function(func, code_dependancies, llm_mode, args, manifest=None):
+    """
+    Generate and verify documentation for a single custom function/method/class.
+
+    Input:
+        func (str): Name of the function/method/class to document.
+        code_dependancies (CodeData): Code data; all dependencies of `func` must already be processed.
+        llm_mode (str): The mode of the language model to be used.
+        args (Namespace): A namespace object containing arguments like max_retries, etc.
+        manifest (dict): Manifest of the previous incremental run, None if not running incrementally.
+
+    Returns:
+        dict: Result of the generation with the keys
+            - code_new (str): Documented code, '-' if generation failed
+            - doc (str): Generated docstring, '-' if generation failed
+            - doc_short (str): Shortened docstring used as reference documentation for dependents
+            - tries (int): Number of LLM calls made
+            - reason (str): Reason for the last failure, if any
+            - tokens (Counter): Tokens used across all tries
+            - hash (str): Hash of the function without its docstring
+            - code_hash (str): Hash of the source of the function, including its comments and formatting
+            - ref_hash (str): Hash of the reference documentation used in the prompt
+            - reused (bool): True if the documentation was taken from the manifest
+            - tokens_saved (int): Estimated number of reference documentation tokens trimmed to fit the context
+            - seconds (float): Time spent documenting the function
+
+    Raises:
+        Exception: If the LLM could not be reached.
+    """
+    start = time.monotonic()
+    metrics = get_metrics()
+
+    source = code = code_dependancies.code(func)
+    node = code_dependancies.node(func)
+    skeleton = None
+
+    # Fit the reference documentation into the context left after the system prompt and the completion
+    with metrics.stage(REFERENCE_LOOKUP):
+        ref_docs = get_reference_docs_custom_functions(func, code_dependancies)
+        if isinstance(node, ast.ClassDef):
+            # The methods of a class are already documented, only send their signatures and docstrings
+            methods = {child.name for child in node.body if isinstance(child, (ast.FunctionDef, ast.AsyncFunctionDef))}
+            code = skeleton = get_class_skeleton(node, {method: code_dependancies[f'{func}.{method}'][CodeData.DOC] for method in methods})
+            ref_docs = [ref_doc for ref_doc in ref_docs if ref_doc['function'] not in {f'{func}.{method}' for method in methods}]
+
+        prompt, ref_docs, tokens_saved = build_doc_generation_prompt(
+            code,
+            ref_docs,
+            args.context_size - estimate_tokens(SYSTEM_PROMPT) - args.max_tokens if args.context_size else None,
+            DOC_ONLY_GENERATION_PROMPT if args.doc_only else DOC_GENERATION_PROMPT,
+        )
+    if tokens_saved:
+        logging.debug(f'\tTrimmed reference docs of `{func}` by ~{tokens_saved} tokens to fit the context')
+
+    result = {
+        'code_new': '-', 'doc': '-', 'doc_short': '-', 'tries': 0, 'reason': None, 'tokens': TOK_COUNT.copy(),
+        'hash': None, 'code_hash': None, 'ref_hash': None, 'reused': False, 'tokens_saved': tokens_saved, 'seconds': 0.0,
+    }
+
+    if manifest is not None:
+        # Reuse the previous documentation if neither the code nor the reference documentation changed
+        result['hash'], result['ref_hash'] = get_fingerprint(func, code_dependancies), hash_ref_docs(ref_docs)
+        result['code_hash'] = hash_code(source)
+        entry = manifest.get(get_manifest_key(args.path, code_dependancies[func][CodeData.PATH], func))
+        if entry and entry['hash'] == result['hash'] and entry['ref_hash'] == result['ref_hash']:
+            if entry.get('code_hash') == result['code_hash']:
+                code_new = entry['code_new']
+            else:
+                # Only comments or formatting changed, insert the previous docstring into the current code instead
+                new_code, _, success, _ = insert_documentation(func, source, node, entry['doc'], header_only=skeleton is not None)
+                code_new = code_dependancies[func][CodeData.CODE_INDENT] + new_code if success else None
+            if code_new is not None:
+                result.update({'code_new': code_new, 'doc': entry['doc'], 'doc_short': entry['doc_short'], 'reused': True})
+                result['seconds'] = time.monotonic() - start
+                return result
+
+    # Attempts are requested --candidates at a time, the first candidate that passes verification is used
+    for first in range(0, args.max_retries, args.candidates):
+        attempts = list(range(first, min(first + args.candidates, args.max_retries)))
+        logging.debug(f'\tTries {first+1}-{attempts[-1]+1}/{args.max_retries} for `{func}`')
+
+        # Generate documentation using a language model, closing the candidates cancels the pending ones
+        with metrics.stage(GENERATION), closing(get_llm_candidates(SYSTEM_PROMPT, prompt, llm_mode, args, attempts)) as candidates:
+            for llm_out, used_toks in candidates:
+                result['tries'] += 1
+                result['tokens'] += used_toks
+
+                with metrics.stage(VERIFICATION):
+                    new_func_code, new_func_node, success, result['reason'] = check_llm_output(func, llm_out, code_dependancies, skeleton, args.doc_only)
+
+                if success:
+                    if args.doc_only or skeleton is not None:
+                        # Documentation inserted into the original code, whose first line is the only one not indented
+                        result['code_new'] = code_dependancies[func][CodeData.CODE_INDENT] + new_func_code
+                    else:
+                        result['code_new'] = indent_code(new_func_code, new_func_node, code_dependancies[func][CodeData.CODE_INDENT])
+                    result['doc'] = ast.get_docstring(new_func_node)
+                    if result['doc']:
+                        # Only verified outputs are cached, as the first attempt, so a rerun uses them right away
+                        cache_output(SYSTEM_PROMPT, prompt, args, 0, llm_out)
+                    break
+
+        if result['code_new'] != '-':
+            break
+
+    # If documentation was generated, get a shortened version of it for its dependents
+    if result['doc'] and result['doc'] != '-':
+        result['doc_short'] = get_shortened_docs(func, result['doc'], args.ref_doc, llm_mode, args)
+    else:
+        result['doc'] = '-'
+
+    result['seconds'] = time.monotonic() - start
+    return result
 
 
 def generate_documentation_for_custom_calls(code_dependancies, llm_mode, args):
     """
     Generate documentation for custom functions/methods/classes.
 
+    Functions are documented in dependency order: every function whose custom dependencies are already
+    processed is dispatched to a pool of `args.jobs` workers, and its dependents are released as soon as it completes.
+    Since a prompt only depends on the documentation of already processed dependencies, the output is the same as
+    that of a sequential run.
+
     Input:
-        code_dependancies (dict): A dictionary containing function names as keys and their metadata as values.
+        code_dependancies (CodeData): An object containing function names as keys and their metadata as values.
         llm_mode (str): The mode of the language model to be used.
-        args (Namespace): A namespace object containing arguments like max_retries, etc.
+        args (Namespace): A namespace object containing arguments like max_retries, jobs, etc.
 
     Returns:
         None
 
     Raises:
-        TypeError: If the given node does not have docstrings, a TypeError is raised.
+        Exception: If the LLM could not be reached.
     """
     # Fetch the list of custom functions from the code dependencies
     custom_funcs = [func_name for func_name, func_info in code_dependancies.items() if func_info[CodeData.CUSTOM]]
 
     num_custom_funcs = len(custom_funcs)  # Count of custom functions
-    num_digits = math.ceil(math.log(num_custom_funcs, 10))  # Calculate number of digits needed for formatting
-    logging.info(f'Generating docs for {len(custom_funcs)} custom functions/methods/classes')
+    num_digits = len(str(num_custom_funcs))  # Number of digits needed for formatting
+    logging.info(f'Generating docs for {num_custom_funcs} custom functions/methods/classes using {args.jobs} job(s)')
 
-    total_tokens = TOK_COUNT.copy()  # Initialize total token count
+    # Load the documentation generated by the previous run in incremental mode
+    manifest_path = get_manifest_path(args.path, args.manifest_path)
+    manifest = load_manifest(manifest_path) if args.incremental else None
+    new_manifest = {}
 
-    for i in range(num_custom_funcs):
-        # Find the function with the least dependencies
-        least_dep_func = min(custom_funcs, key=lambda x: code_dependancies.undocumented_dependancies(x))
-        reason = None
-        
-        for ri in range(args.max_retries):
-            logging.debug(f'\tTry {ri+1}/{args.max_retries} for `{least_dep_func}`')
-            # Generate documentation using a language model
-            llm_out, used_toks = get_llm_output(
-                SYSTEM_PROMPT, 
-                DOC_GENERATION_PROMPT(
-                    code_dependancies[least_dep_func][CodeData.CODE], 
-                    get_reference_docs_custom_functions(least_dep_func, code_dependancies)
-                ),
-                llm_mode,
-                args,
-            )
-            total_tokens += used_toks  # Update total tokens used
-            
-            # Parse the commented function output from the language model
-            new_func_code, new_func_node, success, reason = parse_commented_function(least_dep_func, llm_out)
-            
-            if not success:
+    # Queue every function without unprocessed custom dependencies
+    code_dependancies.reset_ready()
+
+    total_tokens = TOK_COUNT.copy()  # Initialize total token count
+    num_done, num_reused, tokens_saved = 0, 0, 0
+
+    with ThreadPoolExecutor(max_workers=args.jobs) as executor:
+        in_flight = {}
+        while num_done < num_custom_funcs:
+            # Dispatch every function whose dependencies are processed
+            while code_dependancies.has_ready():
+                func = code_dependancies.pop_ready()
+                in_flight[executor.submit(document_function, func, code_dependancies, llm_mode, args, manifest)] = func
+
+            if not in_flight:
+                # Only cyclic dependencies are left, force the function with the least unprocessed dependencies
+                code_dependancies.force_ready()
                 continue
-        
-            # Compare the abstract syntax tree (AST) of the original and the new function
-            same, ast_reason = same_ast_with_reason(remove_docstring(code_dependancies[least_dep_func][CodeData.NODE]), remove_docstring(new_func_node))
-            if same:
-                code_dependancies.add(
-                    least_dep_func,
-                    {
-                        CodeData.CODE_NEW: '\n'.join([code_dependancies[least_dep_func][CodeData.CODE_INDENT] + line for line in new_func_code.split('\n')]),
-                        CodeData.DOC: ast.get_docstring(new_func_node),
-                    }
+
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in sorted(done, key=lambda fut: code_dependancies.order[in_flight[fut]]):
+                func = in_flight.pop(future)
+                result = future.result()
+                total_tokens += result['tokens']  # Update total tokens used
+                tokens_saved += result['tokens_saved']
+                num_done += 1
+                get_metrics().record_function(
+                    func, code_dependancies[func][CodeData.PATH], result['seconds'], result['tokens'], result['tries'],
+                    None if result['doc'] != '-' else result['reason'] or 'No docstring generated', result['reused'],
                 )
-                logging.info(f'\t[{str(i+1).zfill(num_digits)}/{str(num_custom_funcs).zfill(num_digits)}] Generated docs for `{least_dep_func}` in {ri+1}/{args.max_retries} tries')      
-                break
-            else:
-                reason = f'AST mismatch: {ast_reason}'
-        else:
-            logging.info(f'\t[{str(i+1).zfill(num_digits)}/{str(num_custom_funcs).zfill(num_digits)}] Could not generate docs for `{least_dep_func}` after {args.max_retries} tries')
-            logging.info(f'\t\tReason: {reason}')
-        
-        # If documentation was generated, get a shortened version of it
-        if code_dependancies[least_dep_func][CodeData.DOC] != '-':
-            code_dependancies.add(
-                least_dep_func, 
-                {CodeData.DOC_SHORT: get_shortened_docs(least_dep_func, CodeData.DOC, args.ref_doc, llm_mode, args)}
-            )            
-
-        custom_funcs.remove(least_dep_func)  # Remove the processed function from the list
-        
+
+                if result['doc'] != '-':
+                    code_dependancies.add(
+                        func,
+                        {
+                            CodeData.CODE_NEW: result['code_new'],
+                            CodeData.DOC: result['doc'],
+                            CodeData.DOC_SHORT: result['doc_short'],
+                        }
+                    )
+                    if result['reused']:
+                        num_reused += 1
+                        logging.info(f'\t[{str(num_done).zfill(num_digits)}/{num_custom_funcs}] Reused docs for unchanged `{func}`')
+                    else:
+                        logging.info(f'\t[{str(num_done).zfill(num_digits)}/{num_custom_funcs}] Generated docs for `{func}` in {result["tries"]}/{args.max_retries} tries')
+
+                    if manifest is not None:
+                        key = get_manifest_key(args.path, code_dependancies[func][CodeData.PATH], func)
+                        new_manifest[key] = {
+                            'path': code_dependancies[func][CodeData.PATH],
+                            'name': func,
+                            'hash': result['hash'],
+                            'code_hash': result['code_hash'],
+                            'ref_hash': result['ref_hash'],
+                            'doc': result['doc'],
+                            'doc_short': result['doc_short'],
+                            'code_new': result['code_new'],
+                        }
+                else:
+                    logging.info(f'\t[{str(num_done).zfill(num_digits)}/{num_custom_funcs}] Could not generate docs for `{func}` after {args.max_retries} tries')
+                    logging.info(f'\t\tReason: {result["reason"]}')
+
+                # Release the dependents of the processed function, and its node which is no longer needed
+                code_dependancies.complete(func)
+                code_dependancies.release(func)
+
     # Generate a list of custom functions that have documentation
     custom_funcs_with_docs = [func_name for func_name, func_info in code_dependancies.items() if func_info[CodeData.CUSTOM] and func_info[CodeData.DOC] != '-']
     logging.info(f'Generated docs for {len(custom_funcs_with_docs)}/{num_custom_funcs} custom functions/classes.methods')
-    logging.info(f'Tokens used: ' + ', '.join(f'{k}: {v}' for k,v in total_tokens.items()))
+    if tokens_saved:
+        logging.info(f'Trimmed ~{tokens_saved} tokens of reference docs to fit prompts into {args.context_size} tokens')
+
+    if manifest is not None:
+        logging.info(f'Reused docs for {num_reused}/{num_custom_funcs} unchanged custom functions/classes/methods')
+        save_manifest(manifest_path, new_manifest)
+
+    cache = get_cache()
+    logging.info(f'Tokens used: ' + ', '.join(f'{k}: {total_tokens[k]}' for k in TOK_COUNT) + (f', {cache.stats()}' if cache else ''))
     
     
 def replace_modified_functions(code_dependancies, path):
     """
     Replaces modified functions in the given code dependencies with new versions.
 
+    The functions of each file are replaced at the byte offsets recorded by the project scan in a single pass, and the
+    file is written once, atomically.
+
     Input:
     code_dependancies: dict
         A dictionary containing information about the code dependencies, where keys are function names and values are metadata.
@@ -317,27 +832,66 @@ def replace_modified_functions(code_dependancies, path):
     KeyError: If expected keys are not found in the code_dependancies dictionary.
     """
     
-    # List comprehension to gather functions with custom implementations and documentation
-    custom_funcs_with_docs = [func_name for func_name, func_info in code_dependancies.items() if func_info[CodeData.CUSTOM] and func_info[CodeData.DOC] != '-']
-    # Sort functions with classes first
-    custom_funcs_with_docs = sorted(custom_funcs_with_docs, key = lambda func: 1 if code_dependancies[func][CodeData.TYPE] == 'class' else 0)    
-    
-    for func in custom_funcs_with_docs: 
-        fpath = code_dependancies[func][CodeData.PATH]
-        
+    # Group the functions with custom implementations and documentation by file
+    files = {}
+    for func_name, func_info in code_dependancies.items():
+        if func_info[CodeData.CUSTOM] and func_info[CodeData.DOC] != '-':
+            files.setdefault(func_info[CodeData.PATH], []).append(func_name)
+
+    for fpath, funcs in files.items():
         # Read the existing file content
-        with open(fpath) as f:    
-            file_str = f.read()
-        
-        # Replace the old function code with the new one
-        file_str = replace_func(
-                        func, 
-                        code_dependancies[func][CodeData.CODE], 
-                        code_dependancies[func][CodeData.CODE_NEW], 
-                        fpath,
-                        file_str
-                    )
+        with open(fpath, 'rb') as f:
+            buf = f.read()
+
+        edits = []
+        for func in funcs:
+            blob = code_dependancies[func]
+            start, end = blob[CodeData.SPAN]
+            indent = blob[CodeData.CODE_INDENT].encode('utf-8')
+
+            # The code at the recorded offsets must still be the scanned code (in low memory mode only the offsets are kept)
+            orig_code = read_segment(buf, start, end)
+            if blob[CodeData.CODE] not in ('-', orig_code) or buf[start - len(indent):start] != indent:
+                logging.error(f'Could not replace `{func}` in file `{fpath}` (Changed since it was scanned)')
+                continue
+
+            if blob[CodeData.TYPE] == 'class':
+                # Only the header and docstring of a class are replaced, its methods are replaced on their own
+                num_lines = get_class_header(orig_code, ast.parse(orig_code).body[0]).count('\n') + 1
+                header_lines = buf[start:end].splitlines(keepends=True)[:num_lines]
+                # Up to the line ending of the last line of the header, which may be a blank line below the definition
+                end = start + sum(map(len, header_lines)) - (len(header_lines[-1]) - len(header_lines[-1].rstrip(b'\r\n')))
 
-        # Write the updated content back to the file
-        with open(fpath, 'w') as f:
-            f.write(file_str)
\ No newline at end of file
+            # The new code starts with the indentation of the definition line
+            edits.append((func, start - len(indent), end, blob[CodeData.CODE_NEW]))
+
+        if edits:
+            # Write the updated content back to the file
+            write_file_atomic(fpath, splice_code(edits, fpath, buf))
+
+
+def write_file_atomic(fpath, data):
+    """
+    Write a file through a temporary file in the same folder that replaces it, so that the file is never partially written.
+
+    Input:
+        fpath (str): Path of the file.
+        data (bytes): The new content of the file.
+
+    Returns:
+        None
+
+    Raises:
+        OSError: If the file can not be written, it is left unchanged.
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(fpath) or '.', prefix=f'.{os.path.basename(fpath)}.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.chmod(tmp_path, stat.S_IMODE(os.stat(fpath).st_mode))  # Keep the permissions of the file
+        os.replace(tmp_path, fpath)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise